@@ -1,7 +1,19 @@
-from flask import Flask, request, redirect, session, url_for, render_template_string, send_file, jsonify
+from flask import Flask, request, redirect, session, url_for, render_template, jsonify, g, Response, stream_with_context, make_response
 import os
-from datetime import date
+import json
+import logging
+import sys
+import threading
+import time
+import calendar
+import hashlib
+import gzip
+import zlib
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
 import sqlite3
+from jinja2 import DictLoader
+from markupsafe import Markup
 
 # -------------------------------------------------
 # MODO BD (Auto: Postgres si hay DATABASE_URL; si no, SQLite)
@@ -10,20 +22,282 @@ USE_PG = bool(os.environ.get("DATABASE_URL"))
 PG_DSN = os.environ.get("DATABASE_URL")
 
 if USE_PG:
-    import psycopg
     from psycopg.rows import dict_row
+    from psycopg_pool import ConnectionPool
 
 APP_SECRET = os.environ.get("APP_SECRET", "dev-secret")
 DB_PATH = os.environ.get("APP_DB", "data.db")  # usado solo si no hay DATABASE_URL
 
+# Pool por proceso (cada worker de gunicorn tiene el suyo)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "5"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+
+# SQLite en producción (sin DATABASE_URL): WAL + pragmas aplicados a cada conexión
+SQLITE_WAL = os.environ.get("SQLITE_WAL", "1") == "1"
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_KB = int(os.environ.get("SQLITE_CACHE_KB", "16384"))
+SQLITE_MMAP_BYTES = int(os.environ.get("SQLITE_MMAP_BYTES", str(128 * 1024 * 1024)))
+
+# Instrumentación (ver sección Métricas)
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "200"))
+REQUEST_LOG = os.environ.get("REQUEST_LOG", "1") == "1"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# /readyz: tiempo máximo para obtener conexión y ejecutar SELECT 1, y presupuesto de latencia
+READY_TIMEOUT = float(os.environ.get("READY_TIMEOUT", "5"))
+READY_BUDGET_MS = float(os.environ.get("READY_BUDGET_MS", "500"))
+
+
+# -------------------------------------------------
+# Pool de conexiones (una conexión por request vía flask.g)
+# -------------------------------------------------
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_sqlite_conns = {}  # ident de hilo -> conexión SQLite reutilizada por ese hilo
+_sqlite_pid = None
+_pool_stats = {"checkouts": 0, "in_use": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+
+def _pg_pool():
+    """Pool psycopg del proceso actual (se recrea tras un fork)."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = ConnectionPool(
+                    PG_DSN, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                    kwargs={"row_factory": dict_row}, open=True,
+                )
+                _pool_pid = pid
+    return _pool
+
+
+def _sqlite_conn():
+    """Conexión SQLite reutilizada por hilo; descarta las de hilos ya terminados."""
+    global _sqlite_pid
+    if _sqlite_pid != os.getpid():
+        # tras un fork el ident del hilo principal puede repetirse: no usar las conexiones del padre
+        with _pool_lock:
+            _sqlite_conns.clear()
+            _sqlite_pid = os.getpid()
+    ident = threading.get_ident()
+    conn = _sqlite_conns.get(ident)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        _sqlite_tune(conn)
+        with _pool_lock:
+            alive = {t.ident for t in threading.enumerate()}
+            for dead in [i for i in _sqlite_conns if i not in alive]:
+                _sqlite_conns.pop(dead).close()
+            _sqlite_conns[ident] = conn
+    return conn
+
+
+# -------------------------------------------------
+# Cursores medidos: cantidad de consultas, tiempo en BD y la más lenta por request
+# -------------------------------------------------
+_query_log = logging.getLogger("metamantenedor.sql")
+
+
+def _record_query(sql, ms):
+    st = g.get("_qstats")
+    if st is None:
+        st = g._qstats = {"n": 0, "ms": 0.0, "slow_ms": 0.0, "slow_sql": ""}
+    st["n"] += 1
+    st["ms"] += ms
+    if ms > st["slow_ms"]:
+        st["slow_ms"], st["slow_sql"] = ms, sql
+    if ms >= SLOW_QUERY_MS:
+        _query_log.warning("consulta lenta %.1f ms: %s", ms, " ".join(str(sql).split())[:300])
+
+
+class TimedCursor:
+    """Envuelve un cursor DB-API y registra el tiempo de execute/executemany en flask.g."""
+
+    def __init__(self, cur, conn):
+        self._cur = cur
+        self._conn = conn
+
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        try:
+            _sqlite_begin_write(self._conn, sql)
+            return self._cur.execute(sql, params)
+        finally:
+            _record_query(sql, (time.perf_counter() - t0) * 1000)
+
+    def executemany(self, sql, seq):
+        t0 = time.perf_counter()
+        try:
+            _sqlite_begin_write(self._conn, sql)
+            return self._cur.executemany(sql, seq)
+        finally:
+            _record_query(sql, (time.perf_counter() - t0) * 1000)
+
+    def fetchmany(self, size):
+        # en cursores server-side (export_csv) cada lote es un round trip
+        t0 = time.perf_counter()
+        try:
+            return self._cur.fetchmany(size)
+        finally:
+            st = g.get("_qstats")
+            if st is not None:
+                st["ms"] += (time.perf_counter() - t0) * 1000
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+class TimedConnection:
+    """Conexión cuyo cursor() devuelve TimedCursor; commit/rollback liberan el escritor SQLite."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self._conn.cursor(*args, **kwargs), self._conn)
+
+    def commit(self):
+        try:
+            self._conn.commit()
+        finally:
+            _sqlite_end_write()
+
+    def rollback(self):
+        try:
+            self._conn.rollback()
+        finally:
+            _sqlite_end_write()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def query_stats():
+    """{'n', 'ms', 'slow_ms', 'slow_sql'} de las consultas hechas en el contexto actual."""
+    return g.get("_qstats") or {"n": 0, "ms": 0.0, "slow_ms": 0.0, "slow_sql": ""}
+
+
+def _sqlite_tune(conn):
+    """Pragmas por conexión: WAL (lectores sin bloquear al escritor), busy_timeout y caché/mmap."""
+    if SQLITE_WAL:
+        conn.execute("PRAGMA journal_mode=WAL")  # persiste en el archivo; barato si ya está
+        conn.execute("PRAGMA synchronous=NORMAL")  # seguro con WAL: fsync solo en checkpoint
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+
+
+# -------------------------------------------------
+# Escritor único SQLite: una transacción de escritura a la vez por proceso
+# -------------------------------------------------
+# Las transacciones empiezan con BEGIN IMMEDIATE (el lock de escritura se toma
+# al inicio y busy_timeout sirve entre procesos) y los hilos del proceso hacen
+# cola en _sqlite_writer en vez de chocar con "database is locked". En WAL los
+# lectores nunca esperan al escritor.
+_sqlite_writer = threading.Lock()
+_WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+def _sqlite_begin_write(conn, sql):
+    if USE_PG or conn.in_transaction or not str(sql).lstrip()[:7].upper().startswith(_WRITE_PREFIXES):
+        return
+    if not g.get("_writer_held"):
+        if not _sqlite_writer.acquire(timeout=SQLITE_BUSY_TIMEOUT_MS / 1000):
+            raise sqlite3.OperationalError("database is locked (cola del escritor)")
+        g._writer_held = True
+    conn.execute("BEGIN IMMEDIATE")
+
+
+def _sqlite_end_write():
+    if g.pop("_writer_held", False):
+        _sqlite_writer.release()
+
 
 def db():
-    """Conexión a la BD (Postgres o SQLite)."""
+    """Conexión de la request/app context actual (Postgres desde el pool o SQLite por hilo).
+
+    Se entrega siempre la misma conexión dentro de un contexto y se devuelve
+    al pool en el teardown; las rutas no deben cerrarla. Sus cursores quedan
+    medidos (ver TimedCursor).
+    """
+    wrapped = g.get("_db")
+    if wrapped is None:
+        t0 = time.perf_counter()
+        conn = _pg_pool().getconn() if USE_PG else _sqlite_conn()
+        waited = (time.perf_counter() - t0) * 1000
+        with _pool_lock:
+            _pool_stats["checkouts"] += 1
+            _pool_stats["in_use"] += 1
+            _pool_stats["wait_ms_total"] += waited
+            _pool_stats["wait_ms_max"] = max(_pool_stats["wait_ms_max"], waited)
+        g._db_conn = conn
+        wrapped = g._db = TimedConnection(conn)
+    return wrapped
+
+
+def release_db(exc=None):
+    """Devuelve la conexión del contexto; descarta lo que no se haya confirmado."""
+    g.pop("_db", None)
+    conn = g.pop("_db_conn", None)
+    if conn is None:
+        return
+    try:
+        conn.rollback()
+    finally:
+        _sqlite_end_write()
+        if USE_PG:
+            _pg_pool().putconn(conn)
+        with _pool_lock:
+            _pool_stats["in_use"] -= 1
+
+
+def close_db_connections():
+    """Cierra el pool y las conexiones SQLite de este proceso.
+
+    Con preload_app el master importa la app (init_db, plantillas) y abre
+    conexiones; gunicorn.conf.py lo llama antes de cada fork para que ningún
+    worker herede sockets o handles del master.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        pool, _pool, _pool_pid = _pool, None, None
+        conns = list(_sqlite_conns.values())
+        _sqlite_conns.clear()
+    if pool is not None:
+        pool.close()
+    for conn in conns:
+        conn.close()
+
+
+def db_pool_stats():
+    """Uso del pool en este proceso: conexiones en uso/ociosas y espera al pedirlas."""
+    with _pool_lock:
+        s = dict(_pool_stats)
+        sqlite_open = len(_sqlite_conns)
+    out = {
+        "backend": "postgres" if USE_PG else "sqlite",
+        "pid": os.getpid(),
+        "in_use": s["in_use"],
+        "checkouts": s["checkouts"],
+        "wait_ms_avg": round(s["wait_ms_total"] / s["checkouts"], 3) if s["checkouts"] else 0.0,
+        "wait_ms_max": round(s["wait_ms_max"], 3),
+    }
     if USE_PG:
-        return psycopg.connect(PG_DSN, row_factory=dict_row)
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+        ps = _pool.get_stats() if _pool is not None and _pool_pid == os.getpid() else {}
+        out.update(size=ps.get("pool_size", 0), idle=ps.get("pool_available", 0),
+                   waiting=ps.get("requests_waiting", 0), max_size=DB_POOL_MAX)
+    else:
+        out.update(size=sqlite_open, idle=max(sqlite_open - s["in_use"], 0), waiting=0, max_size=None)
+    return out
 
 
 def q(sql: str) -> str:
@@ -38,6 +312,101 @@ app = Flask(__name__)
 app.config['ENV'] = 'production'
 app.config['DEBUG'] = False
 app.secret_key = APP_SECRET
+app.teardown_appcontext(release_db)
+
+
+# -------------------------------------------------
+# Métricas por request (Server-Timing, log estructurado y /metrics)
+# -------------------------------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # segundos
+
+_metrics_lock = threading.Lock()
+_route_metrics = {}  # (endpoint, método) -> {'buckets': [...], 'count', 'sum', 'queries', 'db_sum'}
+_status_counts = {}  # (endpoint, código) -> n
+
+_request_log = logging.getLogger("metamantenedor.requests")
+if REQUEST_LOG and not _request_log.handlers:
+    _h = logging.StreamHandler(sys.stderr)
+    _h.setFormatter(logging.Formatter("%(message)s"))
+    _request_log.addHandler(_h)
+    _request_log.setLevel(logging.INFO)
+    _request_log.propagate = False
+
+
+@app.before_request
+def _start_timer():
+    g._t0 = time.perf_counter()
+
+
+@app.after_request
+def _finish_timer(resp):
+    t0 = g.pop("_t0", None)
+    if t0 is None:
+        return resp
+    elapsed = time.perf_counter() - t0
+    st = query_stats()
+    endpoint = request.endpoint or "404"
+
+    resp.headers["Server-Timing"] = (
+        f'db;dur={st["ms"]:.1f};desc="{st["n"]} consultas", app;dur={elapsed * 1000:.1f}'
+    )
+    with _metrics_lock:
+        m = _route_metrics.setdefault((endpoint, request.method), {
+            "buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "sum": 0.0, "queries": 0, "db_sum": 0.0})
+        for i, le in enumerate(LATENCY_BUCKETS):
+            if elapsed <= le:
+                m["buckets"][i] += 1
+        m["count"] += 1
+        m["sum"] += elapsed
+        m["queries"] += st["n"]
+        m["db_sum"] += st["ms"] / 1000
+        key = (endpoint, resp.status_code)
+        _status_counts[key] = _status_counts.get(key, 0) + 1
+
+    if REQUEST_LOG:
+        _request_log.info(json.dumps({
+            "method": request.method, "path": request.path, "endpoint": endpoint, "status": resp.status_code,
+            "ms": round(elapsed * 1000, 1), "queries": st["n"], "db_ms": round(st["ms"], 1),
+            "slowest_ms": round(st["slow_ms"], 1), "slowest_sql": " ".join(str(st["slow_sql"]).split())[:200],
+        }, ensure_ascii=False))
+    return resp
+
+
+def metrics_text():
+    """Métricas del proceso en formato de texto de Prometheus (cada worker expone las suyas)."""
+    out = [
+        "# HELP app_request_duration_seconds Latencia por ruta.",
+        "# TYPE app_request_duration_seconds histogram",
+    ]
+    with _metrics_lock:
+        routes = {k: dict(v, buckets=list(v["buckets"])) for k, v in _route_metrics.items()}
+        statuses = dict(_status_counts)
+    for (endpoint, method), m in sorted(routes.items()):
+        lbl = f'endpoint="{endpoint}",method="{method}"'
+        for le, n in zip(LATENCY_BUCKETS, m["buckets"]):
+            out.append(f'app_request_duration_seconds_bucket{{{lbl},le="{le}"}} {n}')
+        out.append(f'app_request_duration_seconds_bucket{{{lbl},le="+Inf"}} {m["count"]}')
+        out.append(f'app_request_duration_seconds_sum{{{lbl}}} {m["sum"]:.6f}')
+        out.append(f'app_request_duration_seconds_count{{{lbl}}} {m["count"]}')
+    out += ["# HELP app_db_queries_total Consultas SQL por ruta.", "# TYPE app_db_queries_total counter"]
+    out += [f'app_db_queries_total{{endpoint="{e}",method="{mt}"}} {m["queries"]}' for (e, mt), m in sorted(routes.items())]
+    out += ["# HELP app_db_seconds_total Tiempo en BD por ruta.", "# TYPE app_db_seconds_total counter"]
+    out += [f'app_db_seconds_total{{endpoint="{e}",method="{mt}"}} {m["db_sum"]:.6f}' for (e, mt), m in sorted(routes.items())]
+    out += ["# HELP app_responses_total Respuestas por ruta y código.", "# TYPE app_responses_total counter"]
+    out += [f'app_responses_total{{endpoint="{e}",code="{c}"}} {n}' for (e, c), n in sorted(statuses.items())]
+
+    ps = db_pool_stats()
+    out += [
+        "# HELP app_db_connections Conexiones a la BD de este proceso.",
+        "# TYPE app_db_connections gauge",
+        f'app_db_connections{{state="in_use"}} {ps["in_use"]}',
+        f'app_db_connections{{state="idle"}} {ps["idle"]}',
+        f'app_db_connections{{state="waiting"}} {ps["waiting"]}',
+        "# HELP app_db_checkouts_total Conexiones entregadas por db().",
+        "# TYPE app_db_checkouts_total counter",
+        f'app_db_checkouts_total {ps["checkouts"]}',
+    ]
+    return "\n".join(out) + "\n"
 
 
 # -------------------------------------------------
@@ -59,14 +428,22 @@ CENTROS = [
     ("ninualac@multix",   "NINUALAC",   "AYSEN"),
 ]
 ADMIN_EMAILS = set(os.environ.get("APP_ADMINS", "rcarcamo@multix").split(","))
-AREAS = sorted({a for _, _, a in CENTROS})
-CENTRO_NOMBRES = sorted({c for _, c, _ in CENTROS})
+
+
+def seed_users():
+    """Filas (email, centro, area) a sembrar en users: centros + admins de APP_ADMINS."""
+    return list(CENTROS) + [(adm.strip().lower(), 'ADMIN', 'SERVICIOS') for adm in sorted(ADMIN_EMAILS)]
+
+
+# cambia si se editan CENTROS o APP_ADMINS: obliga a volver a sembrar en el arranque
+SEED_HASH = hashlib.sha1(repr(seed_users()).encode()).hexdigest()[:12]
 
 
 # -------------------------------------------------
 # INIT DB (dual: Postgres o SQLite)
 # -------------------------------------------------
 def init_db():
+    """Crea tablas, siembra users y aplica migraciones; idempotente (ver ensure_db y `flask migrate`)."""
     conn = db()
     cur = conn.cursor()
 
@@ -106,23 +483,9 @@ def init_db():
         """)
         cur.execute("""
             INSERT INTO settings(key, value)
-            VALUES ('lock_until','')
+            VALUES ('lock_until',''), ('schema_version','0'), ('seed_hash','')
             ON CONFLICT (key) DO NOTHING;
         """)
-        # seed centros
-        for email, centro, area in CENTROS:
-            cur.execute("""
-                INSERT INTO users(email, centro, area)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (email) DO NOTHING;
-            """, (email, centro, area))
-        # seed admins
-        for adm in ADMIN_EMAILS:
-            cur.execute("""
-                INSERT INTO users(email, centro, area)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (email) DO NOTHING;
-            """, (adm.strip().lower(), 'ADMIN', 'SERVICIOS'))
 
     else:
         # --- SQLite
@@ -158,54 +521,718 @@ def init_db():
                 value TEXT
             );
         """)
-        cur.execute("INSERT OR IGNORE INTO settings(key, value) VALUES ('lock_until','')")
-        for email, centro, area in CENTROS:
-            cur.execute("INSERT OR IGNORE INTO users(email, centro, area) VALUES (?,?,?)", (email, centro, area))
-        for adm in ADMIN_EMAILS:
-            cur.execute("INSERT OR IGNORE INTO users(email, centro, area) VALUES (?,?,?)",
-                        (adm.strip().lower(), 'ADMIN', 'SERVICIOS'))
+        cur.execute("INSERT OR IGNORE INTO settings(key, value) VALUES ('lock_until',''), ('schema_version','0'), ('seed_hash','')")
+
+    conn.commit()
+    version = migrate(conn)
+
+    # seed centros + admins (con el esquema ya migrado): executemany, en Postgres va en pipeline
+    users = seed_users()
+    cur.executemany(q("INSERT INTO centros(nombre, area) VALUES (?,?) ON CONFLICT (nombre) DO NOTHING"),
+                    sorted({(centro, area) for _, centro, area in users}))
+    cur.executemany(q("INSERT INTO users(email, centro_id) SELECT ?, id FROM centros WHERE nombre=? ON CONFLICT (email) DO NOTHING"),
+                    [(email, centro) for email, centro, _ in users])
+    cur.execute(q("UPDATE settings SET value=? WHERE key='seed_hash'"), (SEED_HASH,))
+    bump_directory_version(cur)
+    conn.commit()
+    return version
+
+
+def startup_state(conn):
+    """(schema_version, seed_hash) en una sola consulta; (0, '') si la BD aún no tiene tablas."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT key, value FROM settings WHERE key IN ('schema_version', 'seed_hash')")
+        values = {r['key']: r['value'] or '' for r in cur.fetchall()}
+    except Exception:
+        conn.rollback()  # settings no existe: BD nueva
+        return 0, ''
+    try:
+        return int(values.get('schema_version') or 0), values.get('seed_hash', '')
+    except ValueError:
+        return 0, ''
+
+
+def ensure_db():
+    """Arranque rápido: si el esquema y la siembra están al día basta una consulta; si no, init_db()."""
+    version, seed = startup_state(db())
+    if version == SCHEMA_VERSION and seed == SEED_HASH:
+        return False
+    init_db()
+    return True
+
+
+# -------------------------------------------------
+# MIGRACIONES (versión en settings.schema_version)
+# -------------------------------------------------
+_migrate_log = logging.getLogger("metamantenedor.migrate")
+
+
+def _m1_reports_indexes(cur):
+    # admin/admin_centro/admin_update filtran por centro + rango de fecha; export_csv por área + fecha
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reports_centro_fecha ON reports(centro, fecha)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reports_area_fecha ON reports(area, fecha)")
+
+
+def _m2_settings_version(cur):
+    # contador que se incrementa en cada escritura de settings (ver set_setting)
+    if USE_PG:
+        cur.execute("INSERT INTO settings(key, value) VALUES ('settings_version','0') ON CONFLICT (key) DO NOTHING")
+    else:
+        cur.execute("INSERT OR IGNORE INTO settings(key, value) VALUES ('settings_version','0')")
+
+
+def _m3_monthly_grid(cur):
+    # formato original (centro como texto); _m5_centros la rehace por centro_id y hace el backfill
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_grid (
+            centro TEXT NOT NULL,
+            mes TEXT NOT NULL,
+            area TEXT NOT NULL,
+            dias TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (centro, mes)
+        )
+    """)
+
+
+def _m4_grid_version(cur):
+    # contador que se incrementa al cambiar monthly_grid de un mes cerrado (ver bump_grid_version)
+    if USE_PG:
+        cur.execute("INSERT INTO settings(key, value) VALUES ('grid_version','0') ON CONFLICT (key) DO NOTHING")
+    else:
+        cur.execute("INSERT OR IGNORE INTO settings(key, value) VALUES ('grid_version','0')")
+
+
+def _m5_centros(cur):
+    # dimensión centros: users y reports dejan de repetir centro/area como texto y guardan centro_id
+    pk = "SERIAL PRIMARY KEY" if USE_PG else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    cur.execute(f"CREATE TABLE IF NOT EXISTS centros (id {pk}, nombre TEXT UNIQUE NOT NULL, area TEXT NOT NULL)")
+    cur.execute("""
+        INSERT INTO centros(nombre, area)
+        SELECT centro, MIN(area) FROM (SELECT centro, area FROM users UNION ALL SELECT centro, area FROM reports) x
+        GROUP BY centro ORDER BY centro
+    """)
+    cur.execute("DROP INDEX IF EXISTS idx_reports_centro_fecha")
+    cur.execute("DROP INDEX IF EXISTS idx_reports_area_fecha")
+    for tabla in ('users', 'reports'):
+        cur.execute(f"ALTER TABLE {tabla} ADD COLUMN centro_id INTEGER REFERENCES centros(id)")
+        cur.execute(f"UPDATE {tabla} SET centro_id = c.id FROM centros c WHERE c.nombre = {tabla}.centro")
+        # SQLite >= 3.35 para DROP COLUMN; ahí centro_id queda sin NOT NULL (no se puede agregar con ALTER)
+        cur.execute(f"ALTER TABLE {tabla} DROP COLUMN centro")
+        cur.execute(f"ALTER TABLE {tabla} DROP COLUMN area")
+        if USE_PG:
+            cur.execute(f"ALTER TABLE {tabla} ALTER COLUMN centro_id SET NOT NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reports_centro_fecha ON reports(centro_id, fecha)")
+
+    cur.execute("DROP TABLE IF EXISTS monthly_grid")
+    cur.execute("""
+        CREATE TABLE monthly_grid (
+            centro_id INTEGER NOT NULL REFERENCES centros(id),
+            mes TEXT NOT NULL,
+            dias TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (centro_id, mes)
+        )
+    """)
+    rebuild_grid(cur)
+
+
+def _m6_directory_version(cur):
+    # contador que se incrementa al cambiar users/centros (ver bump_directory_version)
+    if USE_PG:
+        cur.execute("INSERT INTO settings(key, value) VALUES ('directory_version','0') ON CONFLICT (key) DO NOTHING")
+    else:
+        cur.execute("INSERT OR IGNORE INTO settings(key, value) VALUES ('directory_version','0')")
+
+
+def _m7_centros_data_version(cur):
+    # versión de los datos de cada centro: sube con cada escritura que pasa por refresh_grid (ver grid_fragments)
+    cur.execute("ALTER TABLE centros ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0")
+
+
+_M8_DUPLICADOS = """
+    SELECT id FROM (
+        SELECT id, ROW_NUMBER() OVER (PARTITION BY centro_id, fecha ORDER BY updated_at DESC, id DESC) AS rn
+        FROM reports
+    ) x WHERE rn > 1
+"""
+
+
+def _m8_reports_centro_fecha_unico(cur):
+    # un report por centro y día (lo que edita el admin); si dos users del centro cargaron el mismo día
+    # queda el último modificado y los demás pasan a reports_duplicados (nada se borra sin copia)
+    cur.execute("CREATE TABLE IF NOT EXISTS reports_duplicados AS SELECT * FROM reports WHERE 1=0")
+    cur.execute(f"INSERT INTO reports_duplicados SELECT * FROM reports WHERE id IN ({_M8_DUPLICADOS})")
+    cur.execute(f"DELETE FROM reports WHERE id IN ({_M8_DUPLICADOS})")
+    if cur.rowcount:
+        _migrate_log.warning("migración 8: %d reports duplicados por (centro_id, fecha) movidos a reports_duplicados",
+                             cur.rowcount)
+    cur.execute("DROP INDEX IF EXISTS idx_reports_centro_fecha")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_reports_centro_fecha ON reports(centro_id, fecha)")
+    rebuild_grid(cur)
+    bump_data_version(cur)
+
+
+# (versión, descripción, función que recibe el cursor). Solo se agregan al final.
+MIGRATIONS = [
+    (1, "índices de reports por (centro, fecha) y (area, fecha)", _m1_reports_indexes),
+    (2, "contador settings_version para la caché de settings", _m2_settings_version),
+    (3, "tabla monthly_grid (rollup por centro y mes; el backfill lo hace la 5)", _m3_monthly_grid),
+    (4, "contador grid_version para la caché de meses cerrados", _m4_grid_version),
+    (5, "tabla centros; users, reports y monthly_grid por centro_id", _m5_centros),
+    (6, "contador directory_version para el directorio en memoria", _m6_directory_version),
+    (7, "centros.data_version para la caché de fragmentos del grid", _m7_centros_data_version),
+    (8, "reports únicos por (centro_id, fecha), sin duplicados", _m8_reports_centro_fecha_unico),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(cur) -> int:
+    cur.execute(q("SELECT value FROM settings WHERE key='schema_version'"))
+    row = cur.fetchone()
+    try:
+        return int(row['value']) if row else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+def migrate(conn):
+    """Aplica en orden las migraciones pendientes; cada una (DDL incluido) en su propia transacción."""
+    cur = conn.cursor()
+    if USE_PG:
+        # varios workers pueden arrancar a la vez: serializar con un advisory lock
+        cur.execute("SELECT pg_advisory_lock(hashtext('metamantenedor_migrate'))")
+    try:
+        current = schema_version(cur)
+        for version, _desc, fn in MIGRATIONS:
+            if version <= current:
+                continue
+            if not USE_PG:
+                # sqlite3 (modo legado) autocommitea el DDL hasta el primer DML: sin BEGIN explícito una
+                # migración que falla a mitad deja tablas/columnas creadas con schema_version sin subir
+                cur.execute("BEGIN IMMEDIATE")
+            fn(cur)
+            cur.execute(q("UPDATE settings SET value=? WHERE key='schema_version'"), (str(version),))
+            conn.commit()
+            current = version
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if USE_PG:
+            cur.execute("SELECT pg_advisory_unlock(hashtext('metamantenedor_migrate'))")
+            conn.commit()
+    return current
+
+
+# -------------------------------------------------
+# Caché de settings (TTL + contador settings_version entre workers)
+# -------------------------------------------------
+SETTINGS_TTL = float(os.environ.get("SETTINGS_TTL", "15"))  # segundos entre chequeos de versión
+
+_settings_lock = threading.Lock()
+_settings_cache = {"values": None, "version": None, "checked_at": 0.0}
+
+
+def _store_settings(rows):
+    values = {r['key']: (r['value'] or '').strip() for r in rows}
+    _settings_cache.update(values=values, version=values.get('settings_version'), checked_at=time.monotonic())
+
+
+def _load_settings(cur):
+    cur.execute("SELECT key, value FROM settings")
+    _store_settings(cur.fetchall())
+
+
+def _settings_fresh():
+    return _settings_cache["values"] is not None and time.monotonic() - _settings_cache["checked_at"] < SETTINGS_TTL
+
 
+def get_setting(key: str, default: str = '') -> str:
+    """Valor de settings desde la caché del proceso.
+
+    Pasado SETTINGS_TTL solo se consulta settings_version; la tabla completa se
+    relee cuando otro worker (o este) la cambió.
+    """
+    if not _settings_fresh():
+        db()  # la conexión se toma antes del lock: esperar al pool con el lock tomado bloquea a quienes ya tienen una
+    with _settings_lock:
+        if not _settings_fresh():
+            cur = db().cursor()
+            if _settings_cache["values"] is None:
+                _load_settings(cur)
+            else:
+                cur.execute("SELECT value FROM settings WHERE key='settings_version'")
+                row = cur.fetchone()
+                if (row['value'] if row else None) != _settings_cache["version"]:
+                    _load_settings(cur)
+                else:
+                    _settings_cache["checked_at"] = time.monotonic()
+        return _settings_cache["values"].get(key, default)
+
+
+def set_setting(cur, key: str, value: str):
+    """Actualiza un setting y sube settings_version; el commit queda a cargo del llamador."""
+    cur.execute(q("UPDATE settings SET value=? WHERE key=?"), (value, key))
+    cur.execute("UPDATE settings SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT) WHERE key='settings_version'")
+
+
+def invalidate_settings():
+    with _settings_lock:
+        _settings_cache.update(values=None, version=None, checked_at=0.0)
+
+
+def unlock_from(lock_until: str) -> str:
+    """Día siguiente al bloqueo ('' si no hay bloqueo o la fecha no es válida)."""
+    if not lock_until:
+        return ''
+    try:
+        return (datetime.fromisoformat(lock_until).date() + timedelta(days=1)).isoformat()
+    except Exception:
+        return ''
+
+
+def lock_state():
+    """(lock_until, unlock_from) según settings; unlock_from es el día siguiente al bloqueo."""
+    lock_until = get_setting('lock_until')
+    return lock_until, unlock_from(lock_until)
+
+
+# -------------------------------------------------
+# Directorio de centros y users (caché del proceso, contador directory_version)
+# -------------------------------------------------
+TABLERO_EXCLUIDOS = ('ADMIN', 'AREA AYSEN')  # no van al tablero (Directory.tablero y admin_centros_sql)
+
+DIRECTORY_CENTROS_SQL = 'SELECT id, nombre AS centro, area FROM centros ORDER BY nombre'
+DIRECTORY_USERS_SQL = 'SELECT u.id, u.email, u.centro_id, c.nombre AS centro, c.area FROM users u JOIN centros c ON c.id = u.centro_id ORDER BY u.id'
+
+
+class Directory:
+    """Foto de centros y users indexada por email, centro y área; solo lectura, se reemplaza entera."""
+
+    def __init__(self, version, centros, users):
+        self.version = version
+        centros = [dict(c) for c in centros]
+        users = [dict(u) for u in users]
+        self.centros = {c['centro']: c for c in centros}    # nombre -> {id, centro, area}
+        self.users = {u['email']: u for u in users}         # email -> {id, email, centro_id, centro, area}
+        self.centro_user = {}                               # nombre -> primer user (menor id): firma lo que carga el admin
+        for u in users:
+            self.centro_user.setdefault(u['centro'], u)
+        self.tablero = [c for c in centros if c['centro'] not in TABLERO_EXCLUIDOS]
+        self.por_area = {}
+        for c in self.tablero:
+            self.por_area.setdefault(c['area'], []).append(c)
+        self.areas = sorted(self.por_area)
+
+    def tablero_de(self, area: str = ''):
+        """Centros del tablero (ordenados por nombre), opcionalmente de un área."""
+        return self.por_area.get(area, []) if area else self.tablero
+
+
+_directory_lock = threading.Lock()
+_directory = {"dir": None}
+
+
+def directory(reload: bool = False) -> Directory:
+    """Directorio vigente; se relee al cambiar directory_version (se ve vía la caché de settings)."""
+    version = get_setting('directory_version')
+    d = _directory["dir"]
+    if reload or d is None or d.version != version:
+        db()  # como en get_setting: la conexión antes del lock
+    with _directory_lock:
+        d = _directory["dir"]
+        if reload or d is None or d.version != version:
+            cur = db().cursor()
+            cur.execute(DIRECTORY_CENTROS_SQL)
+            centros = cur.fetchall()
+            cur.execute(DIRECTORY_USERS_SQL)
+            d = _directory["dir"] = Directory(version, centros, cur.fetchall())
+        return d
+
+
+def bump_directory_version(cur):
+    """Invalida el directorio en todos los workers (altas o cambios en users/centros); el commit queda a cargo del llamador."""
+    cur.execute("UPDATE settings SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT) WHERE key='directory_version'")
+    cur.execute("UPDATE settings SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT) WHERE key='settings_version'")
+
+
+# -------------------------------------------------
+# Rollup mensual (monthly_grid): una fila por centro y mes con los valores por día
+# -------------------------------------------------
+def fecha_valida(fecha: str) -> bool:
+    """True solo para 'YYYY-MM-DD' canónica (strptime acepta también '2026-1-5')."""
+    try:
+        return datetime.strptime(fecha, '%Y-%m-%d').strftime('%Y-%m-%d') == fecha
+    except (TypeError, ValueError):
+        return False
+
+
+def _grid_dias(rows):
+    """{dia: [desayunos, almuerzos, cenas, dotación]} a partir de filas de reports ordenadas por fecha.
+
+    Las filas con fecha no canónica (cargadas antes de validarla) no tienen día en el grid y se omiten.
+    """
+    dias = {}
+    for r in rows:
+        if not fecha_valida(r['fecha']):
+            continue
+        des, alm, cen = r['desayunos'], r['almuerzos'], r['cenas']
+        dias[int(r['fecha'].split('-')[-1])] = [des, alm, cen, round((alm + cen)/2)]
+    return dias
+
+
+GRID_UPSERT_SQL = """
+    INSERT INTO monthly_grid(centro_id, mes, dias) VALUES (?,?,?)
+    ON CONFLICT (centro_id, mes) DO UPDATE
+    SET dias=excluded.dias, updated_at=CURRENT_TIMESTAMP
+"""
+GRID_MONTH_REPORTS_SQL = 'SELECT fecha, desayunos, almuerzos, cenas FROM reports WHERE centro_id=? AND fecha BETWEEN ? AND ? ORDER BY fecha'
+GRID_DELETE_SQL = 'DELETE FROM monthly_grid WHERE centro_id=? AND mes=?'
+
+
+def _upsert_grid(cur, items):
+    cur.executemany(q(GRID_UPSERT_SQL), [(centro_id, mes, json.dumps(dias)) for centro_id, mes, dias in items])
+
+
+def refresh_grid(cur, centro_id: int, fecha: str):
+    """Recalcula la fila de monthly_grid del centro para el mes de `fecha` (misma transacción que la escritura)."""
+    mes = fecha[:7]
+    cur.execute(q(GRID_MONTH_REPORTS_SQL), (centro_id, f"{mes}-01", f"{mes}-31"))
+    rows = cur.fetchall()
+    if rows:
+        _upsert_grid(cur, [(centro_id, mes, _grid_dias(rows))])
+    else:
+        cur.execute(q(GRID_DELETE_SQL), (centro_id, mes))
+    bump_data_version(cur, centro_id)
+    if month_closed(mes):
+        bump_grid_version(cur)
+
+
+BUMP_DATA_VERSION_SQL = 'UPDATE centros SET data_version = data_version + 1'
+
+
+def bump_data_version(cur, centro_id: int = None):
+    """Invalida los fragmentos del grid del centro (o de todos); el commit queda a cargo del llamador."""
+    if centro_id is None:
+        cur.execute(BUMP_DATA_VERSION_SQL)
+    else:
+        cur.execute(q(BUMP_DATA_VERSION_SQL + ' WHERE id=?'), (centro_id,))
+
+
+def rebuild_grid(cur, desde: str = ''):
+    """Regenera monthly_grid desde reports (backfill); `desde` = 'YYYY-MM' limita a meses posteriores."""
+    if desde:
+        cur.execute(q('DELETE FROM monthly_grid WHERE mes >= ?'), (desde,))
+        cur.execute(q('SELECT centro_id, fecha, desayunos, almuerzos, cenas FROM reports WHERE fecha >= ? ORDER BY centro_id, fecha'),
+                    (f"{desde}-01",))
+    else:
+        cur.execute('DELETE FROM monthly_grid')
+        cur.execute('SELECT centro_id, fecha, desayunos, almuerzos, cenas FROM reports ORDER BY centro_id, fecha')
+    items, key, rows = [], None, []
+    for r in cur.fetchall():
+        if not fecha_valida(r['fecha']):
+            continue  # no es de ningún mes (ver _grid_dias)
+        k = (r['centro_id'], r['fecha'][:7])
+        if k != key:
+            if rows:
+                items.append((key[0], key[1], _grid_dias(rows)))
+            key, rows = k, []
+        rows.append(r)
+    if rows:
+        items.append((key[0], key[1], _grid_dias(rows)))
+    if items:
+        _upsert_grid(cur, items)
+    bump_grid_version(cur)
+    return len(items)
+
+
+def grid_values(dias_json, month_days, today_day):
+    """Filas (des, alm, cen, dot) del grid: '-' para días futuros y 'SI' sin información."""
+    dias = {int(k): v for k, v in json.loads(dias_json).items()} if dias_json else {}
+
+    def val_for(d, idx):
+        if d > today_day:
+            return '-'
+        return dias[d][idx] if d in dias else 'SI'
+
+    return [[(d, val_for(d, idx)) for d in month_days] for idx in range(4)]
+
+
+# -------------------------------------------------
+# Calendario de los grids (?year=&month=) y caché de meses cerrados
+# -------------------------------------------------
+MESES = ['Enero','Febrero','Marzo','Abril','Mayo','Junio','Julio','Agosto','Septiembre','Octubre','Noviembre','Diciembre']
+CAL_MIN_YEAR = int(os.environ.get("CAL_MIN_YEAR", "2020"))  # no se navega antes de enero de este año
+CLOSED_CACHE_MAX = int(os.environ.get("CLOSED_CACHE_MAX", "24"))  # meses cerrados en memoria por proceso
+
+
+def month_calendar(year=None, month=None):
+    """Datos del mes pedido para los grids; sin parámetros o fuera de rango, el mes actual.
+
+    `today_day` es el día de hoy en el mes actual, 0 en meses futuros (todo '-') y
+    último día + 1 en meses pasados (sin días futuros ni columna resaltada).
+    """
+    today = date.today()
+    try:
+        first_day = date(int(year), int(month), 1)
+    except (TypeError, ValueError):
+        first_day = today.replace(day=1)
+    if not (CAL_MIN_YEAR <= first_day.year <= today.year + 1):
+        first_day = today.replace(day=1)
+    last_day = calendar.monthrange(first_day.year, first_day.month)[1]
+    prev_month = (first_day - timedelta(days=1)).replace(day=1)
+    next_month = first_day + timedelta(days=last_day)
+
+    is_current = (first_day.year, first_day.month) == (today.year, today.month)
+    if is_current:
+        today_day = today.day
+    else:
+        today_day = last_day + 1 if first_day < today else 0
+
+    return {
+        'year': first_day.year, 'month': first_day.month, 'mes': first_day.isoformat()[:7],
+        'label': f"{MESES[first_day.month-1]} {first_day.year}",
+        'month_days': list(range(1, last_day+1)), 'today_day': today_day, 'is_current': is_current,
+        'prev': (prev_month.year, prev_month.month) if prev_month.year >= CAL_MIN_YEAR else None,
+        'next': (next_month.year, next_month.month) if next_month.year <= today.year + 1 else None,
+    }
+
+
+def calendar_from_request():
+    return month_calendar(request.args.get('year'), request.args.get('month'))
+
+
+def month_closed(mes: str, lock_until: str = None) -> bool:
+    """True si todo el mes 'YYYY-MM' queda dentro del bloqueo (último día <= lock_until)."""
+    if lock_until is None:
+        lock_until = get_setting('lock_until')
+    if not lock_until:
+        return False
+    try:
+        last_day = calendar.monthrange(int(mes[:4]), int(mes[5:7]))[1]
+    except (TypeError, ValueError):
+        return False  # mes mal formado: no hay caché de mes cerrado que invalidar
+    return f"{mes}-{last_day:02d}" <= lock_until
+
+
+BUMP_GRID_SQL = (
+    "UPDATE settings SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT) WHERE key='grid_version'",
+    "UPDATE settings SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT) WHERE key='settings_version'",
+)
+
+
+def bump_grid_version(cur):
+    """Invalida la caché de meses cerrados en todos los workers; el commit queda a cargo del llamador."""
+    for sql in BUMP_GRID_SQL:
+        cur.execute(sql)
+
+
+_closed_lock = threading.Lock()
+_closed_cache = OrderedDict()  # (mes, lock_until, grid_version) -> ({centro_id: data_version}, {centro_id: dias (JSON)}), LRU
+
+
+def month_grid_query(mes: str, centro_id: int = None):
+    """(sql, params) de las filas de monthly_grid del mes, opcionalmente de un centro."""
+    sql, params = 'SELECT centro_id, dias FROM monthly_grid WHERE mes=?', [mes]
+    if centro_id is not None:
+        sql += ' AND centro_id=?'; params.append(centro_id)
+    return q(sql), params
+
+
+def grid_map(rows):
+    return {r['centro_id']: r['dias'] for r in rows}
+
+
+def version_map(rows):
+    return {r['id']: r['data_version'] for r in rows}
+
+
+def closed_cache_get(key, versions, ids):
+    """{centro_id: dias} cacheado del mes, o None si falta o si algún centro de `ids`
+    cambió de data_version desde que se leyó (p. ej. cargó mientras el mes estaba abierto)."""
+    with _closed_lock:
+        hit = _closed_cache.get(key)
+        if hit is None or any(hit[0].get(i) != versions.get(i) for i in ids):
+            return None
+        _closed_cache.move_to_end(key)
+        return hit[1]
+
+
+def closed_cache_put(key, versions, rows):
+    with _closed_lock:
+        _closed_cache[key] = (versions, rows)
+        while len(_closed_cache) > CLOSED_CACHE_MAX:
+            _closed_cache.popitem(last=False)
+
+
+def month_grid(cur, mes: str, lock_until: str, versions: dict, centro_id: int = None):
+    """{centro_id: dias} de monthly_grid para el mes (opcionalmente un solo centro).
+
+    Los meses abiertos se leen en vivo; los cerrados se leen completos una vez y
+    se sirven desde la caché del proceso mientras no cambien lock_until, grid_version
+    ni el data_version (`versions`, leído por el llamador) de los centros pedidos.
+    """
+    if not month_closed(mes, lock_until):
+        cur.execute(*month_grid_query(mes, centro_id))
+        return grid_map(cur.fetchall())
+
+    key = (mes, lock_until, get_setting('grid_version'))
+    rows = closed_cache_get(key, versions, [centro_id] if centro_id is not None else list(versions))
+    if rows is None:
+        # versiones antes que el grid: si una escritura se cuela, la entrada queda vieja y se relee
+        cur.execute(*data_versions_query())
+        snap = version_map(cur.fetchall())
+        cur.execute(*month_grid_query(mes))
+        rows = grid_map(cur.fetchall())
+        closed_cache_put(key, snap, rows)
+    if centro_id is not None:
+        return {centro_id: rows[centro_id]} if centro_id in rows else {}
+    return rows
+
+
+# -------------------------------------------------
+# Caché de fragmentos HTML del grid (por centro, mes, día y centros.data_version)
+# -------------------------------------------------
+FRAGMENT_CACHE_MAX = int(os.environ.get("FRAGMENT_CACHE_MAX", "512"))  # fragmentos renderizados en memoria por proceso
+
+_fragment_lock = threading.Lock()
+_fragment_cache = OrderedDict()  # (plantilla, centro_id, centro, area, mes, hoy, data_version, origen) -> Markup, LRU
+
+
+def data_versions_query(centro_id: int = None):
+    """(sql, params) de centros.data_version, de todos los centros o de uno."""
+    sql, params = 'SELECT id, data_version FROM centros', []
+    if centro_id is not None:
+        sql += ' WHERE id=?'; params.append(centro_id)
+    return q(sql), params
+
+
+def fragment_keys(tpl, cal, centros, versions, origen):
+    """Claves de los fragmentos de cada centro.
+
+    `origen` es (lock_until, grid_version) si el mes está cerrado (el grid sale de la
+    caché de meses cerrados, que otro worker puede ver con hasta SETTINGS_TTL de atraso)
+    y None si se lee en vivo.
+    """
+    hoy = date.today().isoformat()
+    return [(tpl, c['id'], c['centro'], c['area'], cal['mes'], hoy, versions.get(c['id']), origen) for c in centros]
+
+
+def fragment_cache_get(keys):
+    """Fragmentos cacheados en el orden de `keys` (None donde falta)."""
+    with _fragment_lock:
+        out = []
+        for key in keys:
+            html = _fragment_cache.get(key)
+            if html is not None:
+                _fragment_cache.move_to_end(key)
+            out.append(html)
+        return out
+
+
+def fragment_cache_put(key, html):
+    with _fragment_lock:
+        _fragment_cache[key] = html
+        while len(_fragment_cache) > FRAGMENT_CACHE_MAX:
+            _fragment_cache.popitem(last=False)
+
+
+def fragment_context(c, dias, cal):
+    return {'c': c, 'cal': cal, 'rows': grid_values(dias, cal['month_days'], cal['today_day'])}
+
+
+def grid_fragments(cur, tpl, cal, centros):
+    """HTML del grid de cada centro (Markup, en el orden de `centros`).
+
+    La versión de datos se lee antes que el grid: si una escritura se cuela entre
+    ambas lecturas, el fragmento queda bajo la versión vieja y nadie lo vuelve a pedir.
+    Solo los centros que faltan en la caché leen monthly_grid y se renderizan.
+    """
+    if not centros:
+        return []
+    lock_until = get_setting('lock_until')
+    origen = (lock_until, get_setting('grid_version')) if month_closed(cal['mes'], lock_until) else None
+    cur.execute(*data_versions_query(centros[0]['id'] if len(centros) == 1 else None))
+    versions = version_map(cur.fetchall())
+    keys = fragment_keys(tpl, cal, centros, versions, origen)
+    out = fragment_cache_get(keys)
+    missing = [i for i, html in enumerate(out) if html is None]
+    if missing:
+        grid = month_grid(cur, cal['mes'], lock_until, versions, centros[missing[0]]['id'] if len(missing) == 1 else None)
+        t = app.jinja_env.get_template(tpl)
+        for i in missing:
+            out[i] = Markup(t.render(fragment_context(centros[i], grid.get(centros[i]['id']), cal)))
+            fragment_cache_put(keys[i], out[i])
+    return out
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Crea/actualiza el esquema y la siembra fuera del arranque (uso: flask --app app migrate)."""
+    version = init_db()
+    print(f"schema_version: {version} (objetivo {SCHEMA_VERSION}), seed_hash: {SEED_HASH}")
+
+
+@app.cli.command('rebuild-grid')
+def rebuild_grid_command():
+    """Regenera la tabla monthly_grid desde reports (uso: flask --app app rebuild-grid)."""
+    conn = db()
+    cur = conn.cursor()
+    n = rebuild_grid(cur)
+    bump_data_version(cur)
     conn.commit()
-    conn.close()
+    invalidate_settings()
+    print(f"monthly_grid: {n} filas (centro, mes) regeneradas")
 
 
 with app.app_context():
     if not USE_PG and os.path.dirname(DB_PATH):
         os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    init_db()
+    ensure_db()
 
 
 # -------------------------------------------------
 # Templates base
 # -------------------------------------------------
+# --- CSS de todas las páginas: se sirve aparte como /app.css (cacheable, la URL lleva su hash) ---
+APP_CSS = """
+:root{--brand:#1e3a8a;--brand-2:#0ea5e9;--bg:#f7f8fb;--text:#0f172a;--muted:#64748b}
+body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Ubuntu,'Helvetica Neue',Arial,sans-serif;margin:0;background:var(--bg);color:#0f172a;font-size:14px}
+header{display:flex;justify-content:space-between;align-items:center;padding:28px;background:var(--brand);color:#fff}
+main{max-width:1360px;margin:24px auto;padding:0 20px}
+a{color:#0ea5e9;text-decoration:none}
+a:hover{text-decoration:underline}
+.card{background:#fff;border-radius:14px;box-shadow:0 2px 10px rgba(2,6,23,.06);padding:18px;margin-bottom:16px}
+input,select,button{font-size:14px;padding:8px 10px;border-radius:10px;border:1px solid #e5e7eb}
+input[type=date]{padding:6px 8px} label{display:block;margin:8px 0 6px;font-weight:600}
+.row{display:grid;grid-template-columns:repeat(3,1fr);gap:10px}
+.row2{display:grid;grid-template-columns:1fr 1fr;gap:10px}
+.actions{display:flex;gap:10px;margin-top:12px}
+.ok{background:var(--brand);color:#fff;border:none}.warn{background:var(--brand-2);color:#fff;border:none}.danger{background:#ef4444;color:#fff;border:none}
+table{width:100%;border-collapse:collapse} th,td{padding:8px;border-bottom:1px solid #eef2f7;text-align:left;white-space:nowrap}
+thead th{background:#f0f4ff}.badge{padding:3px 7px;border-radius:999px;font-size:11px}
+.b-enviado{background:#dbeafe}.b-aprobado{background:#dcfce7}.b-observado{background:#fee2e2}
+.xscroll{overflow-x:auto}.minw{min-width:1280px}.muted{color:#64748b}.si{color:#dc2626;font-weight:600}.today{outline:2px solid #ef4444; outline-offset:-2px; border-radius:4px}
+.cell-edit{display:flex;gap:6px;align-items:center}
+.small{font-size:12px;padding:4px 8px;border-radius:8px}
+.note{font-size:12px;color:#64748b}
+.pending{background:#fef9c3;border-radius:4px}
+/* vista compacta de los grids: sin atributos por celda; SI = celda vacía, hoy = <col class="hoy"> */
+.gc{font-size:12px}.gc th,.gc td{padding:3px 5px;text-align:center}
+.gc td:empty::after{content:'SI';color:#dc2626;font-weight:600}
+.gc col.hoy{background:#fee2e2}
+"""
+APP_CSS_HASH = hashlib.sha1(APP_CSS.encode()).hexdigest()[:12]
+
 BASE = """
 <!doctype html>
 <html lang="es">
 <head>
   <meta charset="utf-8"/><meta name="viewport" content="width=device-width, initial-scale=1"/>
   <title>{{ title or 'Dotación Comedor Diario' }}</title>
-  <style>
-    :root{--brand:#1e3a8a;--brand-2:#0ea5e9;--bg:#f7f8fb;--text:#0f172a;--muted:#64748b}
-    body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Ubuntu,'Helvetica Neue',Arial,sans-serif;margin:0;background:var(--bg);color:#0f172a;font-size:14px}
-    header{display:flex;justify-content:space-between;align-items:center;padding:28px;background:var(--brand);color:#fff}
-    main{max-width:1360px;margin:24px auto;padding:0 20px}
-    a{color:#0ea5e9;text-decoration:none}
-    a:hover{text-decoration:underline}
-    .card{background:#fff;border-radius:14px;box-shadow:0 2px 10px rgba(2,6,23,.06);padding:18px;margin-bottom:16px}
-    input,select,button{font-size:14px;padding:8px 10px;border-radius:10px;border:1px solid #e5e7eb}
-    input[type=date]{padding:6px 8px} label{display:block;margin:8px 0 6px;font-weight:600}
-    .row{display:grid;grid-template-columns:repeat(3,1fr);gap:10px}
-    .row2{display:grid;grid-template-columns:1fr 1fr;gap:10px}
-    .actions{display:flex;gap:10px;margin-top:12px}
-    .ok{background:var(--brand);color:#fff;border:none}.warn{background:var(--brand-2);color:#fff;border:none}.danger{background:#ef4444;color:#fff;border:none}
-    table{width:100%;border-collapse:collapse} th,td{padding:8px;border-bottom:1px solid #eef2f7;text-align:left;white-space:nowrap}
-    thead th{background:#f0f4ff}.badge{padding:3px 7px;border-radius:999px;font-size:11px}
-    .b-enviado{background:#dbeafe}.b-aprobado{background:#dcfce7}.b-observado{background:#fee2e2}
-    .xscroll{overflow-x:auto}.minw{min-width:1280px}.muted{color:#64748b}.si{color:#dc2626;font-weight:600}.today{outline:2px solid #ef4444; outline-offset:-2px; border-radius:4px}
-    .cell-edit{display:flex;gap:6px;align-items:center}
-    .small{font-size:12px;padding:4px 8px;border-radius:8px}
-    .note{font-size:12px;color:#64748b}
-  </style>
+  <link rel="stylesheet" href="{{ url_for('app_css', v=APP_CSS_HASH) }}"/>
 </head>
 <body>
 <header>
@@ -217,12 +1244,12 @@ BASE = """
     {% endif %}
   </div>
 </header>
-<main>{{ content|safe }}</main>
+<main>{% block content %}{% endblock %}</main>
 </body>
 </html>
 """
 
-LOGIN_TPL = """
+LOGIN_TPL = """{% extends "base.html" %}{% block content %}
 <div class="card">
   <h2>Ingresar</h2>
   <p>Escribe tu <strong>correo corporativo</strong>. No requiere clave.</p>
@@ -233,9 +1260,10 @@ LOGIN_TPL = """
     <div class="actions"><button class="ok" type="submit">Entrar</button></div>
   </form>
 </div>
+{% endblock %}
 """
 
-FORM_TPL = """
+FORM_TPL = """{% extends "base.html" %}{% block content %}
 <div class="card">
   <h2>Carga diaria</h2>
   {% if lock_until %}
@@ -266,32 +1294,9 @@ FORM_TPL = """
 </div>
 
 <div class="card xscroll">
-  <h3 style="margin-top:0;text-align:center">{{ month_label }}</h3>
+  {% include "month_nav.html" %}
   {% if blocks %}
-    {% for b in blocks %}
-      <div class="minw" style="margin-bottom:12px">
-        <table>
-          <thead>
-            <tr>
-              <th>Área</th><th>Centro</th><th>Servicio</th>
-              {% for d in month_days %}<th class="{% if d==today_day %}today{% endif %}">{{ d }}</th>{% endfor %}
-            </tr>
-          </thead>
-          <tbody>
-            <tr><td rowspan="3">{{ b.area }}</td><td rowspan="3">{{ b.centro }}</td>
-              <td><strong>Desayuno</strong></td>
-              {% for d, v in b.des %}<td class="{% if v=='SI' %}si{% endif %} {% if d==today_day %}today{% endif %}">{{ v }}</td>{% endfor %}
-            </tr>
-            <tr><td><strong>Almuerzo</strong></td>
-              {% for d, v in b.alm %}<td class="{% if v=='SI' %}si{% endif %} {% if d==today_day %}today{% endif %}">{{ v }}</td>{% endfor %}
-            </tr>
-            <tr><td><strong>Cena</strong></td>
-              {% for d, v in b.cen %}<td class="{% if v=='SI' %}si{% endif %} {% if d==today_day %}today{% endif %}">{{ v }}</td>{% endfor %}
-            </tr>
-          </tbody>
-        </table>
-      </div>
-    {% endfor %}
+    {% for b in blocks %}{{ b }}{% endfor %}
   {% else %}
     <p class="muted" style="text-align:center">No hay centros para mostrar con los filtros actuales.</p>
   {% endif %}
@@ -301,26 +1306,70 @@ FORM_TPL = """
     <strong>Liberado desde:</strong> {{ unlock_from or '—' }}
   </p>
 </div>
+{% endblock %}
 """
 
-# --- ADMIN resumido: una fila "Dotación" por centro (promedio almuerzo/cena) + link al detalle ---
-ADMIN_TPL = """
-<div class="card" style="display:grid;grid-template-columns:1fr 340px;gap:16px;align-items:start">
-  <div>
-    <h2 style="margin-top:0">Tablero (Admin/Servicios)</h2>
-    <form method="get" id="filtros" class="row2" style="align-items:end">
-      <div>
-        <label>Área</label>
-        <select name="area" onchange="this.form.submit()">
-          <option value="">Todas</option>
-          {% for a in AREAS %}<option value="{{a}}" {% if a==area %}selected{% endif %}>{{a}}</option>{% endfor %}
-        </select>
-      </div>
-      <div>
-        <label>Centro</label>
-        <select name="centro" onchange="this.form.submit()">
-          <option value="">Todos</option>
-          {% for c in CENTROS_OPT %}<option value="{{c}}" {% if c==centro %}selected{% endif %}>{{c}}</option>{% endfor %}
+# --- Navegación de mes compartida por los grids (incluida con nav_endpoint y nav_args) ---
+MONTH_NAV_TPL = """
+<div style="display:flex;justify-content:center;align-items:center;gap:16px;margin-bottom:12px">
+  {% if cal.prev %}<a href="{{ url_for(nav_endpoint, year=cal.prev[0], month=cal.prev[1], **nav_args) }}">← Anterior</a>{% endif %}
+  <h3 style="margin:0;text-align:center">{{ cal.label }}</h3>
+  {% if cal.next %}<a href="{{ url_for(nav_endpoint, year=cal.next[0], month=cal.next[1], **nav_args) }}">Siguiente →</a>{% endif %}
+  {% if not cal.is_current %}<a class="muted" href="{{ url_for(nav_endpoint, **nav_args) }}">Mes actual</a>{% endif %}
+  {% if compact is defined %}<a class="muted" href="{{ url_for(nav_endpoint, year=cal.year, month=cal.month, compacto=0 if compact else 1, **nav_args) }}">{{ 'Vista completa' if compact else 'Vista compacta' }}</a>{% endif %}
+</div>
+"""
+
+# --- Historial del usuario (paginado por keyset sobre (email, fecha)) ---
+HIST_TPL = """{% extends "base.html" %}{% block content %}
+<div class="card">
+  <h2 style="margin-top:0">Historial</h2>
+  {% if rows %}
+    <table>
+      <thead>
+        <tr><th>Fecha</th><th>Desayunos</th><th>Almuerzos</th><th>Cenas</th><th>Total</th><th>Estado</th></tr>
+      </thead>
+      <tbody>
+        {% for r in rows %}
+          <tr>
+            <td>{{ r.fecha }}</td><td>{{ r.desayunos }}</td><td>{{ r.almuerzos }}</td><td>{{ r.cenas }}</td>
+            <td><strong>{{ r.total }}</strong></td>
+            <td><span class="badge b-{{ r.estado }}">{{ r.estado }}</span></td>
+          </tr>
+        {% endfor %}
+      </tbody>
+    </table>
+  {% else %}
+    <p class="muted">No hay registros{% if antes %} anteriores al {{ antes }}{% endif %}.</p>
+  {% endif %}
+  <div class="actions">
+    <a class="warn" style="text-decoration:none;padding:10px 12px;border-radius:10px" href="{{ url_for('formulario') }}">← Volver</a>
+    {% if antes %}<a style="padding:10px 12px" href="{{ url_for('historial') }}">Más recientes</a>{% endif %}
+    {% if next_antes %}<a style="padding:10px 12px" href="{{ url_for('historial', antes=next_antes) }}">Anteriores →</a>{% endif %}
+  </div>
+</div>
+{% endblock %}
+"""
+
+# --- ADMIN resumido: una fila "Dotación" por centro (promedio almuerzo/cena) + link al detalle ---
+ADMIN_TPL = """{% extends "base.html" %}{% block content %}
+<div class="card" style="display:grid;grid-template-columns:1fr 340px;gap:16px;align-items:start">
+  <div>
+    <h2 style="margin-top:0">Tablero (Admin/Servicios)</h2>
+    <form method="get" id="filtros" class="row2" style="align-items:end">
+      <input type="hidden" name="year" value="{{ cal.year }}"/><input type="hidden" name="month" value="{{ cal.month }}"/>
+      <div>
+        <label>Área</label>
+        <select name="area" onchange="this.form.submit()">
+          <option value="">Todas</option>
+          {% for a in AREAS %}<option value="{{a}}" {% if a==area %}selected{% endif %}>{{a}}</option>{% endfor %}
+        </select>
+      </div>
+      <div>
+        <label>Centro</label>
+        <select name="centro" onchange="this.form.submit()">
+          <option value="">Todos</option>
+          {% for c in CENTROS_OPT %}<option value="{{c}}" {% if c==centro %}selected{% endif %}>{{c}}</option>{% endfor %}
         </select>
       </div>
       <div class="actions" style="margin:0">
@@ -343,7 +1392,14 @@ ADMIN_TPL = """
 </div>
 
 <div class="card xscroll" style="overflow-x:auto">
-  <h3 style="margin-top:0;text-align:center">{{ month_label }}</h3>
+  {% include "month_nav.html" %}
+  {% if compact %}
+  <table class="gc">
+    <colgroup><col span="3"/>{% include "grid_hoy.html" %}</colgroup>
+    <thead><tr><th>Área</th><th>Centro</th><th>Servicio</th>{% for d in month_days %}<th>{{ d }}</th>{% endfor %}</tr></thead>
+    <tbody>{% for b in blocks %}{{ b }}{% endfor %}</tbody>
+  </table>
+  {% else %}
   <div class="minw" style="min-width:1280px">
     <table style="table-layout:fixed">
       <colgroup>
@@ -356,28 +1412,22 @@ ADMIN_TPL = """
         </tr>
       </thead>
       <tbody>
-        {% for b in blocks %}
-          <tr>
-            <td>{{ b.area }}</td>
-            <td><a href="{{ url_for('admin_centro', c=b.centro) }}">{{ b.centro }}</a></td>
-            <td><strong>Dotación</strong></td>
-            {% for d, v in b.dot %}
-              <td class="{% if v=='SI' %}si{% endif %} {% if d==today_day %}today{% endif %}">{{ v }}</td>
-            {% endfor %}
-          </tr>
-        {% endfor %}
+        {% for b in blocks %}{{ b }}{% endfor %}
       </tbody>
     </table>
   </div>
+  {% endif %}
   <p class="note">Tip: haz clic en el nombre del centro para abrir el detalle editable.</p>
 </div>
+{% endblock %}
 """
 
 # --- Detalle editable por centro ---
-DETAIL_TPL = """
+DETAIL_TPL = """{% extends "base.html" %}{% block content %}
 <div class="card">
   <h2 style="margin-top:0">Detalle — {{ centro }}</h2>
-  <p class="note">Haz clic en un valor para editarlo. Escribe el número y pulsa <strong>OK</strong> para guardar.</p>
+  {% include "month_nav.html" %}
+  <p class="note">Haz clic en un valor para editarlo y pulsa <strong>OK</strong>. Los cambios quedan pendientes (amarillo) y se guardan juntos con <strong>Guardar todo</strong> o solos a los pocos segundos.</p>
   <div class="xscroll">
     <div class="minw" style="min-width:1280px">
       <table style="table-layout:fixed">
@@ -391,35 +1441,28 @@ DETAIL_TPL = """
           </tr>
         </thead>
         <tbody>
-          {% for svc in ['Desayuno','Almuerzo','Cena'] %}
-            <tr>
-              {% if loop.index == 1 %}<td rowspan="3">{{ area }}</td>{% endif %}
-              <td><strong>{{ svc }}</strong></td>
-              {% set key = 'des' if svc=='Desayuno' else ('alm' if svc=='Almuerzo' else 'cen') %}
-              {% for d, v in rows[key] %}
-                <td class="{% if v=='SI' %}si{% endif %} {% if d==today_day %}today{% endif %}">
-                  {% if v in ['SI','-'] %}
-                    {{ v }}
-                  {% else %}
-                    <span class="cell" data-dia="{{ d }}" data-campo="{{ 'desayunos' if key=='des' else ('almuerzos' if key=='alm' else 'cenas') }}">{{ v }}</span>
-                    <span class="editor" style="display:none">
-                      <input class="small val" type="number" min="0" value="{{ v }}" style="width:68px">
-                      <button class="small okbtn">OK</button>
-                    </span>
-                    <span class="status small" style="display:none">✔️</span>
-                  {% endif %}
-                </td>
-              {% endfor %}
-            </tr>
-          {% endfor %}
+          {{ grid }}
         </tbody>
       </table>
     </div>
   </div>
-  <div class="actions"><a class="warn" href="{{ url_for('admin') }}">← Volver</a></div>
+  <div class="actions">
+    <button class="ok" id="saveall" type="button" disabled>Guardar todo</button>
+    <a class="warn" href="{{ url_for('admin', year=year, month=month) }}">← Volver</a>
+  </div>
 </div>
 
 <script>
+const pending = new Map();   // "dia|campo" -> celda editada aún no guardada
+const saveBtn = document.getElementById('saveall');
+const FLUSH_MS = 5000;       // guardado automático tras la última edición
+let timer = null;
+
+function refreshBtn(){
+  saveBtn.textContent = 'Guardar todo' + (pending.size ? ' (' + pending.size + ')' : '');
+  saveBtn.disabled = pending.size === 0;
+}
+
 document.querySelectorAll('span.cell').forEach(function(el){
   el.addEventListener('click', function(){
     const td = el.parentElement;
@@ -431,53 +1474,376 @@ document.querySelectorAll('span.cell').forEach(function(el){
 });
 
 document.querySelectorAll('.okbtn').forEach(function(btn){
-  btn.addEventListener('click', async function(e){
+  btn.addEventListener('click', function(e){
     e.preventDefault();
     const td = btn.closest('td');
     const cell = td.querySelector('.cell');
-    const editor = td.querySelector('.editor');
-    const status = td.querySelector('.status');
     const val = parseInt(td.querySelector('.val').value || '0');
     const dia = cell.getAttribute('data-dia');
     const campo = cell.getAttribute('data-campo');
 
-    const payload = {
-      centro: "{{ centro }}",
-      fecha: "{{ year }}-{{ '%02d' % month }}-{{ '%02d' % 1 }}".replace('-01', '-' + ('00'+dia).slice(-2)), // yyyy-mm-dd del día del mes actual
-      campo: campo,
-      valor: val
-    };
-
-    try{
-      const r = await fetch("{{ url_for('admin_update') }}", {
-        method: "POST",
-        headers: {"Content-Type":"application/json"},
-        body: JSON.stringify(payload)
-      });
-      const j = await r.json();
-      if(j.ok){
-        cell.textContent = val;
-        editor.style.display='none';
-        cell.style.display='inline';
+    cell.textContent = val;
+    cell.classList.add('pending');
+    td.querySelector('.editor').style.display='none';
+    cell.style.display='inline';
+    const key = dia + '|' + campo;
+    pending.set(key, {
+      key: key, td: td, campo: campo, valor: val,
+      fecha: "{{ year }}-{{ '%02d' % month }}-" + ('00'+dia).slice(-2)  // yyyy-mm-dd del día del mes actual
+    });
+    refreshBtn();
+    clearTimeout(timer);
+    timer = setTimeout(flush, FLUSH_MS);
+  });
+});
+
+function requeue(batch){
+  batch.forEach(function(c){ if(!pending.has(c.key)) pending.set(c.key, c); });
+  refreshBtn();
+}
+
+async function flush(){
+  clearTimeout(timer);
+  if(!pending.size) return;
+  const batch = Array.from(pending.values());
+  pending.clear(); refreshBtn();
+  try{
+    const r = await fetch("{{ url_for('admin_update_batch') }}", {
+      method: "POST",
+      headers: {"Content-Type":"application/json"},
+      body: JSON.stringify({
+        centro: {{ centro|tojson }},
+        cells: batch.map(function(c){ return {fecha: c.fecha, campo: c.campo, valor: c.valor}; })
+      })
+    });
+    const j = await r.json();
+    if(!j.results){
+      requeue(batch);
+      alert("Error: " + (j.error||"no se pudo guardar"));
+      return;
+    }
+    const errors = [];
+    j.results.forEach(function(res){
+      const c = batch[res.i];
+      const status = c.td.querySelector('.status');
+      c.td.querySelector('.cell').classList.remove('pending');
+      if(res.ok){
         status.style.display='inline';
         setTimeout(()=>{ status.style.display='none'; }, 1200);
       }else{
-        alert("Error: " + (j.error||"no se pudo guardar"));
+        errors.push(c.fecha + ' ' + c.campo + ': ' + res.error);
       }
-    }catch(err){
-      alert("Error de red");
-    }
-  });
+    });
+    if(errors.length) alert("Error:\\n" + errors.join("\\n"));
+  }catch(err){
+    requeue(batch);
+    alert("Error de red; los cambios siguen pendientes.");
+  }
+}
+
+saveBtn.addEventListener('click', flush);
+window.addEventListener('beforeunload', function(e){
+  if(pending.size){ e.preventDefault(); e.returnValue = ''; }
 });
 </script>
+{% endblock %}
+"""
+
+# --- Fragmentos del grid, uno por centro (c, rows = grid_values, cal); se cachean ya renderizados (ver grid_fragments) ---
+GRID_FORM_TPL = """
+      <div class="minw" style="margin-bottom:12px">
+        <table>
+          <thead>
+            <tr>
+              <th>Área</th><th>Centro</th><th>Servicio</th>
+              {% for d in cal.month_days %}<th class="{% if d==cal.today_day %}today{% endif %}">{{ d }}</th>{% endfor %}
+            </tr>
+          </thead>
+          <tbody>
+            <tr><td rowspan="3">{{ c.area }}</td><td rowspan="3">{{ c.centro }}</td>
+              <td><strong>Desayuno</strong></td>
+              {% for d, v in rows[0] %}<td class="{% if v=='SI' %}si{% endif %} {% if d==cal.today_day %}today{% endif %}">{{ v }}</td>{% endfor %}
+            </tr>
+            <tr><td><strong>Almuerzo</strong></td>
+              {% for d, v in rows[1] %}<td class="{% if v=='SI' %}si{% endif %} {% if d==cal.today_day %}today{% endif %}">{{ v }}</td>{% endfor %}
+            </tr>
+            <tr><td><strong>Cena</strong></td>
+              {% for d, v in rows[2] %}<td class="{% if v=='SI' %}si{% endif %} {% if d==cal.today_day %}today{% endif %}">{{ v }}</td>{% endfor %}
+            </tr>
+          </tbody>
+        </table>
+      </div>
+"""
+
+GRID_ADMIN_TPL = """
+          <tr>
+            <td>{{ c.area }}</td>
+            <td><a href="{{ url_for('admin_centro', c=c.centro, year=cal.year, month=cal.month) }}">{{ c.centro }}</a></td>
+            <td><strong>Dotación</strong></td>
+            {% for d, v in rows[3] %}
+              <td class="{% if v=='SI' %}si{% endif %} {% if d==cal.today_day %}today{% endif %}">{{ v }}</td>
+            {% endfor %}
+          </tr>
+"""
+
+GRID_DETAIL_TPL = """
+          {% for svc, campo in [('Desayuno','desayunos'),('Almuerzo','almuerzos'),('Cena','cenas')] %}
+            <tr>
+              {% if loop.index == 1 %}<td rowspan="3">{{ c.area }}</td>{% endif %}
+              <td><strong>{{ svc }}</strong></td>
+              {% for d, v in rows[loop.index0] %}
+                <td class="{% if v=='SI' %}si{% endif %} {% if d==cal.today_day %}today{% endif %}">
+                  {% if v in ['SI','-'] %}
+                    {{ v }}
+                  {% else %}
+                    <span class="cell" data-dia="{{ d }}" data-campo="{{ campo }}">{{ v }}</span>
+                    <span class="editor" style="display:none">
+                      <input class="small val" type="number" min="0" value="{{ v }}" style="width:68px">
+                      <button class="small okbtn">OK</button>
+                    </span>
+                    <span class="status small" style="display:none">✔️</span>
+                  {% endif %}
+                </td>
+              {% endfor %}
+            </tr>
+          {% endfor %}
+"""
+
+# --- Vista compacta (?compacto=1 o Save-Data): una fila por servicio, celdas sin atributos ---
+GRID_HOY_TPL = """{% if 0 < cal.today_day <= cal.month_days|length %}{% if cal.today_day > 1 %}<col span="{{ cal.today_day - 1 }}"/>{% endif %}<col class="hoy"/>{% endif %}"""
+
+GRID_FORM_C_TPL = """
+<table class="gc">
+  <colgroup><col span="3"/>{% include "grid_hoy.html" %}</colgroup>
+  <thead><tr><th>Área</th><th>Centro</th><th>Servicio</th>{% for d in cal.month_days %}<th>{{ d }}</th>{% endfor %}</tr></thead>
+  <tbody>
+  {%- for svc in ['Desayuno','Almuerzo','Cena'] %}
+    <tr>{% if loop.first %}<td rowspan="3">{{ c.area }}</td><td rowspan="3">{{ c.centro }}</td>{% endif %}<th>{{ svc }}</th>
+      {%- for d, v in rows[loop.index0] %}<td>{{ '' if v == 'SI' else v }}</td>{% endfor %}</tr>
+  {%- endfor %}
+  </tbody>
+</table>
+"""
+
+GRID_ADMIN_C_TPL = """
+<tr><td>{{ c.area }}</td><td><a href="{{ url_for('admin_centro', c=c.centro, year=cal.year, month=cal.month) }}">{{ c.centro }}</a></td><th>Dotación</th>
+  {%- for d, v in rows[3] %}<td>{{ '' if v == 'SI' else v }}</td>{% endfor %}</tr>
 """
 
 # -------------------------------------------------
-# Helper render
+# Helper render (plantillas compiladas una vez y cacheadas por Jinja)
 # -------------------------------------------------
-def render_page(inner_tpl, **ctx):
-    inner = render_template_string(inner_tpl, **ctx)
-    return render_template_string(BASE, content=inner, **ctx)
+TEMPLATES = {
+    'base.html': BASE,
+    'month_nav.html': MONTH_NAV_TPL,
+    'login.html': LOGIN_TPL,
+    'historial.html': HIST_TPL,
+    'form.html': FORM_TPL,
+    'admin.html': ADMIN_TPL,
+    'detail.html': DETAIL_TPL,
+    'grid_form.html': GRID_FORM_TPL,
+    'grid_admin.html': GRID_ADMIN_TPL,
+    'grid_detail.html': GRID_DETAIL_TPL,
+    'grid_hoy.html': GRID_HOY_TPL,
+    'grid_form_c.html': GRID_FORM_C_TPL,
+    'grid_admin_c.html': GRID_ADMIN_C_TPL,
+}
+app.jinja_loader = DictLoader(TEMPLATES)
+app.jinja_env.globals['APP_CSS_HASH'] = APP_CSS_HASH
+
+
+def compile_templates():
+    """Compila todas las plantillas en la caché del entorno Jinja de la app (no-op si ya están)."""
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+    return len(TEMPLATES)
+
+
+def render_page(tpl_name, **ctx):
+    return render_template(tpl_name, **ctx)
+
+
+def compact_mode(args, headers, sess):
+    """Vista compacta de los grids: ?compacto=1|0 la fija en la sesión; sin preferencia, sigue a `Save-Data: on`."""
+    v = args.get('compacto')
+    if v in ('0', '1'):
+        sess['compacto'] = v == '1'
+    if 'compacto' in sess:
+        return sess['compacto']
+    return headers.get('Save-Data', '').strip().lower() == 'on'
+
+
+@app.get('/app.css')
+def app_css():
+    """CSS compartido; con ?v=<hash vigente> se cachea un año (al cambiar el CSS cambia la URL)."""
+    resp = Response(APP_CSS, mimetype='text/css')
+    resp.set_etag(APP_CSS_HASH, weak=True)
+    versioned = request.args.get('v') == APP_CSS_HASH
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable' if versioned else 'public, max-age=300'
+    return resp.make_conditional(request)
+
+
+compile_templates()
+
+
+# -------------------------------------------------
+# Caché HTTP (ETag / Last-Modified según los reports del alcance filtrado)
+# -------------------------------------------------
+# cambia con cada deploy que toque las plantillas; igual en todos los workers
+TEMPLATES_HASH = hashlib.sha1(("".join(TEMPLATES[k] for k in sorted(TEMPLATES)) + APP_CSS).encode()).hexdigest()[:12]
+
+
+def _as_utc(v):
+    """updated_at (datetime de Postgres o texto de SQLite, ambos en UTC) como datetime con zona."""
+    if not v:
+        return None
+    try:
+        dt = v if hasattr(v, "tzinfo") else datetime.fromisoformat(str(v).replace("Z", ""))
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def reports_validators(cur, where, params, *extra):
+    """(etag, last_modified) de los reports que cumplen `where`.
+
+    El ETag combina COUNT(*) del alcance y la suma de centros.data_version de sus
+    centros (sube con cada escritura, ver refresh_grid) con `extra` (lock_until,
+    filtros, mes, usuario...): dos ediciones en el mismo segundo cambian el ETag
+    aunque MAX(updated_at) no se mueva. Una sola consulta decide si hace falta
+    volver a generar la página o el CSV.
+    """
+    cur.execute(validators_sql(where), params)
+    return validators_from_row(cur.fetchone(), extra)
+
+
+def validators_sql(where):
+    scope = 'SELECT centro_id, updated_at FROM reports'
+    if where: scope += ' WHERE ' + ' AND '.join(where)
+    return q(f"""
+        WITH s AS ({scope})
+        SELECT (SELECT MAX(updated_at) FROM s) AS mx, (SELECT COUNT(*) FROM s) AS n,
+               (SELECT COALESCE(SUM(data_version), 0) FROM centros WHERE id IN (SELECT centro_id FROM s)) AS v
+    """)
+
+
+def validators_from_row(r, extra):
+    parts = [str(r['mx'] or ''), str(r['n']), str(r['v'])] + [str(x) for x in extra]
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()[:24], _as_utc(r['mx'])
+
+
+def month_scope(centro_id, mes):
+    """(where, params) de los reports de un centro en el mes 'YYYY-MM'."""
+    return ['centro_id = ?', 'fecha BETWEEN ? AND ?'], [centro_id, f"{mes}-01", f"{mes}-31"]
+
+
+def centro_filters(area, centro):
+    """(where, params) sobre reports.centro_id para los filtros por nombre de área y de centro."""
+    where, params = [], []
+    if area:
+        where.append('centro_id IN (SELECT id FROM centros WHERE area = ?)'); params.append(area)
+    if centro:
+        where.append('centro_id IN (SELECT id FROM centros WHERE nombre = ?)'); params.append(centro)
+    return where, params
+
+
+def with_validators(resp, etag, last_modified):
+    resp.set_etag(etag, weak=True)
+    if last_modified:
+        resp.last_modified = last_modified
+    resp.headers['Cache-Control'] = 'private, no-cache'  # el navegador guarda la copia pero revalida siempre
+    return resp
+
+
+def not_modified(etag, last_modified):
+    """304 sin cuerpo si el If-None-Match del cliente coincide; None si hay que generar la respuesta.
+
+    Solo decide el ETag: Last-Modified no cambia al mover lock_until, así que
+    If-Modified-Since por sí solo no basta para responder 304.
+    """
+    if request.if_none_match.contains_weak(etag):
+        return with_validators(Response(status=304), etag, last_modified)
+    return None
+
+
+# -------------------------------------------------
+# Compresión de respuestas (br/gzip según Accept-Encoding; export.csv comprime al vuelo)
+# -------------------------------------------------
+try:
+    import brotli  # opcional: sin el paquete solo se negocia gzip
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "512"))  # debajo de esto no compensa
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "5"))  # ~gzip -9 en tamaño, rápido para HTML dinámico
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/csv', 'text/plain', 'application/json')
+
+
+def pick_encoding(accept):
+    """'br', 'gzip' o None según Accept-Encoding (werkzeug Accept ya parseado)."""
+    if brotli is not None and accept.quality('br') > 0:
+        return 'br'
+    if accept.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+
+def compressible(status, mimetype, content_encoding):
+    return 200 <= status < 300 and status != 204 and not content_encoding and mimetype in COMPRESSIBLE_TYPES
+
+
+class Compressor:
+    """Compresión incremental; cada trozo sale con flush para que el streaming no quede retenido."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._c = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: contenedor gzip
+
+    def chunk(self, data: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self._c.process(data) + self._c.flush()
+        return self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._c.finish() if self.encoding == 'br' else self._c.flush()
+
+
+def compress_bytes(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+
+def compress_iter(chunks, encoding):
+    c = Compressor(encoding)
+    for chunk in chunks:
+        if chunk:
+            yield c.chunk(chunk.encode() if isinstance(chunk, str) else chunk)
+    yield c.finish()
+
+
+@app.after_request
+def _compress(resp):
+    if not compressible(resp.status_code, resp.mimetype, resp.headers.get('Content-Encoding')):
+        return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = pick_encoding(request.accept_encodings)
+    if encoding is None or request.method == 'HEAD':
+        return resp
+    if resp.is_streamed:
+        resp.response = compress_iter(resp.response, encoding)
+        resp.headers.pop('Content-Length', None)
+    else:
+        data = resp.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return resp
+        resp.set_data(compress_bytes(data, encoding))
+    resp.headers['Content-Encoding'] = encoding
+    return resp
 
 
 # -------------------------------------------------
@@ -489,8 +1855,10 @@ def admin_lock():
         return redirect(url_for('login'))
     lock_until = (request.form.get('lock_until') or '').strip()
     conn = db(); cur = conn.cursor()
-    cur.execute(q("UPDATE settings SET value=? WHERE key='lock_until'"), (lock_until,))
-    conn.commit(); conn.close()
+    set_setting(cur, 'lock_until', lock_until)
+    bump_grid_version(cur)  # los meses que entran o salen del bloqueo no reutilizan la caché vieja
+    conn.commit()
+    invalidate_settings()
     return redirect(url_for('admin'))
 
 @app.route('/admin/lock/clear')
@@ -498,8 +1866,10 @@ def admin_lock_clear():
     if not session.get('email') or session['email'] not in ADMIN_EMAILS:
         return redirect(url_for('login'))
     conn = db(); cur = conn.cursor()
-    cur.execute(q("UPDATE settings SET value='' WHERE key='lock_until'"))
-    conn.commit(); conn.close()
+    set_setting(cur, 'lock_until', '')
+    bump_grid_version(cur)
+    conn.commit()
+    invalidate_settings()
     return redirect(url_for('admin'))
 
 
@@ -516,19 +1886,19 @@ def root():
 def login():
     if request.method == 'POST':
         email = (request.form.get('email') or '').strip().lower()
-        conn = db(); cur = conn.cursor()
-        cur.execute(q('SELECT * FROM users WHERE email=?'), (email,))
-        u = cur.fetchone(); conn.close()
+        # un correo desconocido relee el directorio (altas hechas directo en la BD)
+        u = directory().users.get(email) or directory(reload=True).users.get(email)
         if not u:
-            return render_page(LOGIN_TPL, title='Ingresar', error='Correo no habilitado. Solicita a Servicios/TI el alta de tu centro.')
+            return render_page('login.html', title='Ingresar', error='Correo no habilitado. Solicita a Servicios/TI el alta de tu centro.')
         session['email'] = u['email']
+        session['centro_id'] = u['centro_id']
         session['centro'] = u['centro']
         session['area'] = u['area']
         session['user_id'] = u['id']
         if session['email'] in ADMIN_EMAILS:
             return redirect(url_for('admin'))
         return redirect(url_for('formulario'))
-    return render_page(LOGIN_TPL, title='Ingresar', error=None)
+    return render_page('login.html', title='Ingresar', error=None)
 
 @app.route('/logout')
 def logout():
@@ -537,115 +1907,192 @@ def logout():
 
 @app.get('/healthz')
 def healthz():
+    # liveness: no toca la BD
     return jsonify(status="ok"), 200
 
+
+def db_ping():
+    """Milisegundos de un SELECT 1 por el pool, acotado por READY_TIMEOUT (espera de conexión y sentencia)."""
+    t0 = time.perf_counter()
+    if USE_PG:
+        pool = _pg_pool()
+        conn = pool.getconn(timeout=READY_TIMEOUT)
+        try:
+            cur = conn.cursor()
+            cur.execute(f"SET LOCAL statement_timeout = {int(READY_TIMEOUT * 1000)}")
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+        finally:
+            pool.putconn(conn)
+    else:
+        _sqlite_conn().execute("SELECT 1").fetchone()
+    return (time.perf_counter() - t0) * 1000
+
+
+_ready_log = logging.getLogger("metamantenedor.readyz")
+
+
+@app.get('/readyz')
+def readyz():
+    """Readiness: BD respondiendo dentro de READY_BUDGET_MS y plantillas compiladas; si no, 503."""
+    templates = compile_templates()
+    try:
+        db_ms, error = db_ping(), None
+    except Exception as e:
+        # sin autenticación: el detalle (host, usuario del DSN...) va solo al log
+        _ready_log.warning("readyz: BD no disponible: %s: %s", type(e).__name__, e)
+        db_ms, error = None, type(e).__name__
+    ps = db_pool_stats()
+    saturation = round(ps["in_use"] / ps["max_size"], 3) if ps["max_size"] else None
+    ready = error is None and db_ms <= READY_BUDGET_MS
+    return jsonify(
+        status="ready" if ready else "not_ready", error=error,
+        db_ms=round(db_ms, 2) if db_ms is not None else None, budget_ms=READY_BUDGET_MS,
+        templates=templates, pool=dict(ps, saturation=saturation),
+    ), 200 if ready else 503
+
+@app.get('/admin/pool')
+def admin_pool():
+    if not session.get('email') or session['email'] not in ADMIN_EMAILS:
+        return jsonify(ok=False, error="no_auth"), 403
+    return jsonify(db_pool_stats())
+
+@app.get('/metrics')
+def metrics():
+    # Prometheus: Authorization: Bearer $METRICS_TOKEN; desde el navegador basta la sesión de admin
+    token_ok = bool(METRICS_TOKEN) and request.headers.get('Authorization', '') == f"Bearer {METRICS_TOKEN}"
+    if not token_ok and (not session.get('email') or session['email'] not in ADMIN_EMAILS):
+        return Response("no_auth\n", status=403, mimetype='text/plain')
+    return Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
 def require_login():
-    if not session.get('email'):
+    # las sesiones anteriores a la tabla centros no traen centro_id: se vuelve a ingresar
+    if not session.get('email') or 'centro_id' not in session:
         return redirect(url_for('login'))
 
 
+REPORT_INSERT_SQL = """
+    INSERT INTO reports(user_id, email, centro_id, fecha, desayunos, almuerzos, cenas, total)
+    VALUES (?,?,?,?,?,?,?,?)
+    ON CONFLICT DO NOTHING
+"""
+
+
+def parse_report_form(form, lock_until):
+    """(fecha, (des, alm, cen), None) del formulario de carga, o (fecha, None, mensaje de error)."""
+    fecha = (form.get('fecha') or '').strip()
+    if not fecha_valida(fecha):
+        return fecha, None, 'Selecciona una fecha.'
+    if lock_until and fecha <= lock_until:
+        return fecha, None, f'Fecha bloqueada por administración (<= {lock_until}).'
+    try:
+        vals = tuple(int(form.get(k) or 0) for k in ('desayunos', 'almuerzos', 'cenas'))
+    except ValueError:
+        vals = (-1,)
+    if min(vals) < 0:
+        return fecha, None, 'Valores inválidos. Usa números enteros >= 0.'
+    return fecha, vals, None
+
+
 @app.route('/form', methods=['GET', 'POST'])
 def formulario():
     if require_login():
         return require_login()
-    from datetime import datetime, timedelta
-    today = date.today()
-    first_day = today.replace(day=1)
-    next_month = first_day.replace(year=first_day.year + 1, month=1) if first_day.month == 12 else first_day.replace(month=first_day.month + 1)
-    last_day = (next_month - timedelta(days=1)).day
+    cal = calendar_from_request()
+    compact = compact_mode(request.args, request.headers, session)
 
     msg_ok = msg_err = None
     datos = {"desayunos":0, "almuerzos":0, "cenas":0, "total":0}
     selected_fecha = ''
 
     conn = db(); cur = conn.cursor()
-    cur.execute(q("SELECT value FROM settings WHERE key='lock_until'"))
-    row = cur.fetchone(); lock_until = (row['value'] or '').strip() if row else ''
-    unlock_from = ''
-    if lock_until:
-        try:
-            unlock_from = (datetime.fromisoformat(lock_until).date() + timedelta(days=1)).isoformat()
-        except Exception:
-            unlock_from = ''
+    lock_until, unlock_from = lock_state()
 
     if request.method == 'POST':
-        fecha = (request.form.get('fecha') or '').strip()
+        fecha, vals, msg_err = parse_report_form(request.form, lock_until)
         selected_fecha = fecha
-        if not fecha:
-            msg_err = 'Selecciona una fecha.'
-        elif lock_until and fecha <= lock_until:
-            msg_err = f'Fecha bloqueada por administración (<= {lock_until}).'
-        else:
-            try:
-                des = int(request.form.get('desayunos') or 0)
-                alm = int(request.form.get('almuerzos') or 0)
-                cen = int(request.form.get('cenas') or 0)
-            except ValueError:
-                des = alm = cen = -1
-            if min(des, alm, cen) < 0:
-                msg_err = 'Valores inválidos. Usa números enteros >= 0.'
+        if vals:
+            des, alm, cen = vals
+            total = des + alm + cen
+            # Una sola sentencia atómica: si el día ya está cargado (por este user u otro del centro) no inserta nada (rowcount 0)
+            cur.execute(q(REPORT_INSERT_SQL),
+                        (session['user_id'], session['email'], session['centro_id'], fecha, des, alm, cen, total))
+            if cur.rowcount == 0:
+                conn.rollback()
+                msg_err = 'Ese día ya está cargado. Si necesitas corregirlo, contacta a Servicios.'
             else:
-                total = des + alm + cen
-                cur2 = db().cursor()
-                cur2.execute(q('SELECT 1 FROM reports WHERE email=? AND fecha=?'), (session['email'], fecha))
-                exists = cur2.fetchone() is not None
-                if exists:
-                    msg_err = 'Ese día ya está cargado. Si necesitas corregirlo, contacta a Servicios.'
-                else:
-                    conn2 = db(); c2 = conn2.cursor()
-                    c2.execute(q("""
-                        INSERT INTO reports(user_id, email, centro, area, fecha, desayunos, almuerzos, cenas, total)
-                        VALUES (?,?,?,?,?,?,?,?,?)
-                    """), (session['user_id'], session['email'], session['centro'], session['area'], fecha, des, alm, cen, total))
-                    conn2.commit(); conn2.close()
-                    msg_ok = 'Registro enviado.'
-                    datos = {"desayunos":des, "almuerzos":alm, "cenas":cen, "total":total}
-                    selected_fecha = ''
-
-    cur.execute(q('SELECT fecha, desayunos, almuerzos, cenas FROM reports WHERE email=? AND fecha BETWEEN ? AND ? ORDER BY fecha'),
-                (session['email'], first_day.isoformat(), today.replace(day=last_day).isoformat()))
-    rows = cur.fetchall(); conn.close()
-    day_map = {int(r['fecha'].split('-')[-1]): (r['desayunos'], r['almuerzos'], r['cenas']) for r in rows}
-    month_days = list(range(1, last_day+1)); today_day = today.day
-
-    def val_for(d, idx):
-        if d > today_day:
-            return '-'
-        return day_map[d][idx] if d in day_map else 'SI'
-
-    row_des = [val_for(d,0) for d in month_days]
-    row_alm = [val_for(d,1) for d in month_days]
-    row_cen = [val_for(d,2) for d in month_days]
-    meses = ['Enero','Febrero','Marzo','Abril','Mayo','Junio','Julio','Agosto','Septiembre','Octubre','Noviembre','Diciembre']
-    month_label = f"{meses[today.month-1]} {today.year}"
-
-    blocks = [{
-        'centro': session['centro'], 'area': session['area'],
-        'des': list(zip(month_days, row_des)),
-        'alm': list(zip(month_days, row_alm)),
-        'cen': list(zip(month_days, row_cen)),
-    }]
-
-    return render_page(
-        FORM_TPL, title='Carga diaria', hoy=today.isoformat(), datos=datos, ok=msg_ok, error=msg_err,
-        lock_until=lock_until, selected_fecha=selected_fecha, month_days=month_days, month_label=month_label,
-        today_day=today_day, unlock_from=unlock_from, blocks=blocks
+                refresh_grid(cur, session['centro_id'], fecha)
+                conn.commit()
+                msg_ok = 'Registro enviado.'
+                datos = {"desayunos":des, "almuerzos":alm, "cenas":cen, "total":total}
+                selected_fecha = ''
+
+    if request.method == 'GET':
+        etag, last_mod = reports_validators(cur, *month_scope(session['centro_id'], cal['mes']),
+            session['email'], lock_until, cal['mes'], date.today().isoformat(), compact, TEMPLATES_HASH)
+        cached = not_modified(etag, last_mod)
+        if cached:
+            return cached
+
+    blocks = grid_fragments(cur, 'grid_form_c.html' if compact else 'grid_form.html', cal,
+                            [{'id': session['centro_id'], 'centro': session['centro'], 'area': session['area']}])
+
+    html = render_page(
+        'form.html', title='Carga diaria', hoy=date.today().isoformat(), datos=datos, ok=msg_ok, error=msg_err,
+        lock_until=lock_until, selected_fecha=selected_fecha, month_days=cal['month_days'], cal=cal,
+        today_day=cal['today_day'], unlock_from=unlock_from, blocks=blocks, compact=compact,
+        nav_endpoint='formulario', nav_args={}
     )
+    if request.method == 'GET':
+        return with_validators(make_response(html), etag, last_mod)
+    return html
+
+
+HISTORIAL_PAGE = int(os.environ.get("HISTORIAL_PAGE", "31"))
 
 
 @app.route('/historial')
 def historial():
     if require_login():
         return require_login()
+    antes = (request.args.get('antes') or '').strip()  # cursor: última fecha de la página anterior
     conn = db(); cur = conn.cursor()
-    cur.execute(q('SELECT * FROM reports WHERE email=? ORDER BY fecha DESC'), (session['email'],))
-    rows = cur.fetchall(); conn.close()
-    return render_page(LOGIN_TPL.replace("Ingresar","Historial").replace("</form>",""), title='Historial', rows=rows)  # simple
+    sql = 'SELECT fecha, desayunos, almuerzos, cenas, total, estado FROM reports WHERE email=?'
+    params = [session['email']]
+    if antes:
+        sql += ' AND fecha < ?'; params.append(antes)
+    sql += ' ORDER BY fecha DESC LIMIT ?'; params.append(HISTORIAL_PAGE + 1)
+    cur.execute(q(sql), params)
+    rows = cur.fetchall()
+    next_antes = rows[HISTORIAL_PAGE - 1]['fecha'] if len(rows) > HISTORIAL_PAGE else ''
+    return render_page('historial.html', title='Historial', rows=rows[:HISTORIAL_PAGE], antes=antes, next_antes=next_antes)
 
 
 # -------------------------------------------------
 # ADMIN (resumen con link al detalle)
 # -------------------------------------------------
+def admin_scope(area, centro, mes):
+    """(where, params) de los reports que muestra /admin con sus filtros."""
+    where, params = centro_filters(area, centro)
+    return ['fecha BETWEEN ? AND ?'] + where, [f"{mes}-01", f"{mes}-31"] + params
+
+
+def admin_centros_sql(area):
+    """(sql, params) de los centros del tablero (id, centro, area), filtrados por área; subconsulta de /api/stats."""
+    return """
+        SELECT id, nombre AS centro, area FROM centros
+        WHERE nombre NOT IN ({excl}){area_f}
+    """.format(excl=",".join("?" * len(TABLERO_EXCLUIDOS)), area_f=" AND area=?" if area else ""), \
+        list(TABLERO_EXCLUIDOS) + ([area] if area else [])
+
+
+def admin_tablero(dir_, area, centro):
+    """(centros del selector, centros que se muestran) del tablero según los filtros."""
+    centros = dir_.tablero_de(area)
+    return [c['centro'] for c in centros], [c for c in centros if not centro or c['centro'] == centro]
+
+
 @app.route('/admin')
 def admin():
     if not session.get('email') or session['email'] not in ADMIN_EMAILS:
@@ -654,62 +2101,27 @@ def admin():
     centro = (request.args.get('centro') or '').strip()
 
     conn = db(); cur = conn.cursor()
-    cur.execute(q("SELECT value FROM settings WHERE key='lock_until'"))
-    srow = cur.fetchone(); lock_until = (srow['value'] or '').strip() if srow else ''
-    from datetime import datetime, timedelta
-    unlock_from = ''
-    if lock_until:
-        try:
-            unlock_from = (datetime.fromisoformat(lock_until).date() + timedelta(days=1)).isoformat()
-        except Exception:
-            unlock_from = ''
-
-    today = date.today()
-    first_day = today.replace(day=1)
-    next_month = first_day.replace(year=first_day.year+1, month=1) if first_day.month == 12 else first_day.replace(month=first_day.month+1)
-    last_day = (next_month - timedelta(days=1)).day
-    month_days = list(range(1, last_day+1))
-    meses = ['Enero','Febrero','Marzo','Abril','Mayo','Junio','Julio','Agosto','Septiembre','Octubre','Noviembre','Diciembre']
-    month_label = f"{meses[today.month-1]} {today.year}"
-    today_day = today.day
-
-    if area:
-        cur.execute(q("SELECT centro FROM users WHERE area=? AND centro NOT IN ('ADMIN','AREA AYSEN') ORDER BY centro"), (area,))
-    else:
-        cur.execute(q("SELECT centro FROM users WHERE centro NOT IN ('ADMIN','AREA AYSEN') ORDER BY centro"))
-    centers_all = [r['centro'] for r in cur.fetchall()]
-    CENTROS_OPT = centers_all[:]
-    centers_to_show = [c for c in centers_all if (not centro or c == centro)]
-
-    def build_block(cname: str):
-        cur.execute(q('SELECT fecha, desayunos, almuerzos, cenas, area FROM reports WHERE centro=? AND fecha BETWEEN ? AND ? ORDER BY fecha'),
-                    (cname, first_day.isoformat(), today.replace(day=last_day).isoformat()))
-        rws = cur.fetchall()
-        if rws:
-            carea = rws[0]['area']
-        else:
-            cur.execute(q('SELECT area FROM users WHERE centro=? LIMIT 1'), (cname,))
-            urow = cur.fetchone(); carea = (urow['area'] if urow else '')
-        dmap = {int(r['fecha'].split('-')[-1]): (r['desayunos'], r['almuerzos'], r['cenas']) for r in rws}
-
-        def dot_val(d):
-            if d > today_day:
-                return '-'
-            if d in dmap:
-                _, alm, cen = dmap[d]
-                return round((alm + cen)/2)
-            return 'SI'
-
-        row_dot = [dot_val(d) for d in month_days]
-        return {'centro': cname, 'area': carea, 'dot': list(zip(month_days, row_dot))}
-
-    blocks = [build_block(c) for c in centers_to_show]
-    conn.close()
-
-    return render_page(ADMIN_TPL, title='Tablero', AREAS=AREAS, area=area, centro=centro, CENTROS_OPT=CENTROS_OPT,
-        lock_until=lock_until, unlock_from=unlock_from, month_days=month_days, month_label=month_label,
-        today_day=today_day, blocks=blocks
+    lock_until, unlock_from = lock_state()
+    cal = calendar_from_request()
+    month_days, today_day = cal['month_days'], cal['today_day']
+    compact = compact_mode(request.args, request.headers, session)
+
+    dir_ = directory()
+    etag, last_mod = reports_validators(cur, *admin_scope(area, centro, cal['mes']), session['email'], lock_until,
+                                        area, centro, cal['mes'], date.today().isoformat(), dir_.version, compact, TEMPLATES_HASH)
+    cached = not_modified(etag, last_mod)
+    if cached:
+        return cached
+
+    # centros del directorio; cada fila sale de la caché de fragmentos o se renderiza desde el grid del mes
+    CENTROS_OPT, centros = admin_tablero(dir_, area, centro)
+    blocks = grid_fragments(cur, 'grid_admin_c.html' if compact else 'grid_admin.html', cal, centros)
+
+    html = render_page('admin.html', title='Tablero', AREAS=dir_.areas, area=area, centro=centro, CENTROS_OPT=CENTROS_OPT,
+        lock_until=lock_until, unlock_from=unlock_from, month_days=month_days, cal=cal,
+        today_day=today_day, blocks=blocks, compact=compact, nav_endpoint='admin', nav_args={'area': area, 'centro': centro}
     )
+    return with_validators(make_response(html), etag, last_mod)
 
 
 # -------------------------------------------------
@@ -723,156 +2135,426 @@ def admin_centro():
     if not centro:
         return redirect(url_for('admin'))
 
-    conn = db(); cur = conn.cursor()
-    # área
-    cur.execute(q('SELECT area FROM users WHERE centro=? LIMIT 1'), (centro,))
-    u = cur.fetchone()
-    area = u['area'] if u else ''
+    dir_ = directory()
+    c = dir_.centros.get(centro)
+    if not c:
+        return redirect(url_for('admin'))
+    cur = db().cursor()
 
-    today = date.today()
-    first_day = today.replace(day=1)
-    next_month = first_day.replace(year=first_day.year+1, month=1) if first_day.month == 12 else first_day.replace(month=first_day.month+1)
-    last_day = (next_month - __import__('datetime').timedelta(days=1)).day
-    month_days = list(range(1, last_day+1))
-    today_day = today.day
-    year, month = today.year, today.month
-
-    cur.execute(q('SELECT fecha, desayunos, almuerzos, cenas FROM reports WHERE centro=? AND fecha BETWEEN ? AND ? ORDER BY fecha'),
-                (centro, first_day.isoformat(), today.replace(day=last_day).isoformat()))
-    rws = cur.fetchall(); conn.close()
-    dmap = {int(r['fecha'].split('-')[-1]): (r['desayunos'], r['almuerzos'], r['cenas']) for r in rws}
+    cal = calendar_from_request()
+    etag, last_mod = reports_validators(cur, *month_scope(c['id'], cal['mes']), session['email'], get_setting('lock_until'),
+        centro, cal['mes'], date.today().isoformat(), dir_.version, TEMPLATES_HASH)
+    cached = not_modified(etag, last_mod)
+    if cached:
+        return cached
 
-    def val_for(d, idx):
-        if d > today_day:
-            return '-'
-        return dmap[d][idx] if d in dmap else 'SI'
-
-    row_des = [val_for(d,0) for d in month_days]
-    row_alm = [val_for(d,1) for d in month_days]
-    row_cen = [val_for(d,2) for d in month_days]
-
-    return render_page(
-        DETAIL_TPL, title=f'Detalle {centro}', centro=centro, area=area,
-        month_days=month_days, today_day=today_day,
-        rows={'des': list(zip(month_days, row_des)),
-              'alm': list(zip(month_days, row_alm)),
-              'cen': list(zip(month_days, row_cen))},
-        year=year, month=month
+    grid = grid_fragments(cur, 'grid_detail.html', cal, [c])[0]
+
+    html = render_page(
+        'detail.html', title=f'Detalle {centro}', centro=centro,
+        month_days=cal['month_days'], today_day=cal['today_day'], grid=grid,
+        year=cal['year'], month=cal['month'], cal=cal, nav_endpoint='admin_centro', nav_args={'c': centro}
     )
+    return with_validators(make_response(html), etag, last_mod)
 
 
 # -------------------------------------------------
-# ADMIN — API update (guardar edición inmediata)
+# ADMIN — API update (guardar edición inmediata, una celda o un lote del detalle)
 # -------------------------------------------------
-@app.post('/admin/update')
-def admin_update():
-    if not session.get('email') or session['email'] not in ADMIN_EMAILS:
-        return jsonify(ok=False, error="no_auth"), 403
-    data = request.get_json(force=True, silent=True) or {}
-    centro = (data.get('centro') or '').strip()
-    fecha  = (data.get('fecha') or '').strip()
-    campo  = (data.get('campo') or '').strip()   # desayunos | almuerzos | cenas
+def _parse_cell(data):
+    """(fecha, campo, valor) de una celda editada, o (None, código de error)."""
+    fecha = str(data.get('fecha') or '').strip()
+    campo = str(data.get('campo') or '').strip()   # desayunos | almuerzos | cenas
     try:
         valor = int(data.get('valor'))
         if valor < 0: raise ValueError
     except Exception:
-        return jsonify(ok=False, error="valor_invalido"), 400
+        return None, "valor_invalido"
+    if campo not in ('desayunos','almuerzos','cenas') or not fecha_valida(fecha):
+        return None, "payload_invalido"
+    return (fecha, campo, valor), None
+
+
+def _apply_cell_stmt(u, fecha, campo, valor):
+    """(sql, params) del upsert atómico de una celda: inserta con ceros salvo el campo editado, o actualiza campo y total.
 
-    if campo not in ('desayunos','almuerzos','cenas') or not centro or not fecha:
+    El conflicto es por (centro_id, fecha): se edita el report del centro para ese día aunque lo haya
+    cargado otro user del centro (conserva su user_id/email).
+    """
+    des = valor if campo == 'desayunos' else 0
+    alm = valor if campo == 'almuerzos' else 0
+    cen = valor if campo == 'cenas' else 0
+    return q(f"""
+        INSERT INTO reports(user_id, email, centro_id, fecha, desayunos, almuerzos, cenas, total)
+        VALUES (?,?,?,?,?,?,?,?)
+        ON CONFLICT (centro_id, fecha) DO UPDATE
+        SET {campo}=excluded.{campo},
+            total=reports.desayunos + reports.almuerzos + reports.cenas - reports.{campo} + excluded.{campo},
+            updated_at=CURRENT_TIMESTAMP
+    """), (u['id'], u['email'], u['centro_id'], fecha, des, alm, cen, des + alm + cen)
+
+
+def _apply_cell(cur, u, fecha, campo, valor):
+    cur.execute(*_apply_cell_stmt(u, fecha, campo, valor))
+
+
+@app.post('/admin/update')
+def admin_update():
+    if not session.get('email') or session['email'] not in ADMIN_EMAILS:
+        return jsonify(ok=False, error="no_auth"), 403
+    data = request.get_json(force=True, silent=True) or {}
+    centro = str(data.get('centro') or '').strip()
+    cell, err = _parse_cell(data)
+    if err:
+        return jsonify(ok=False, error=err), 400
+    if not centro:
         return jsonify(ok=False, error="payload_invalido"), 400
+    fecha, campo, valor = cell
 
-    conn = db(); cur = conn.cursor()
-    # Buscar un user de ese centro para llenar user_id/email/area
-    cur.execute(q('SELECT id, email, area FROM users WHERE centro=? LIMIT 1'), (centro,))
-    u = cur.fetchone()
+    # el primer user del centro llena user_id/email/centro_id
+    u = directory().centro_user.get(centro)
     if not u:
-        conn.close()
         return jsonify(ok=False, error="centro_no_configurado"), 400
+    conn = db(); cur = conn.cursor()
 
-    # ¿Existe report para ese centro-fecha?
-    cur.execute(q('SELECT id, desayunos, almuerzos, cenas FROM reports WHERE centro=? AND fecha=? LIMIT 1'), (centro, fecha))
-    r = cur.fetchone()
-
-    if r:
-        # update campo y total
-        des, alm, cen = r['desayunos'], r['almuerzos'], r['cenas']
-        if campo == 'desayunos': des = valor
-        elif campo == 'almuerzos': alm = valor
-        else: cen = valor
-        total = des + alm + cen
-        cur.execute(q(f'UPDATE reports SET {campo}=?, total=?, updated_at=CURRENT_TIMESTAMP WHERE id=?'),
-                    (valor, total, r['id']))
-    else:
-        # insert con ceros excepto campo editado
-        des = valor if campo == 'desayunos' else 0
-        alm = valor if campo == 'almuerzos' else 0
-        cen = valor if campo == 'cenas' else 0
-        total = des + alm + cen
-        cur.execute(q("""
-            INSERT INTO reports(user_id, email, centro, area, fecha, desayunos, almuerzos, cenas, total)
-            VALUES (?,?,?,?,?,?,?,?,?)
-        """), (u['id'], u['email'], centro, u['area'], fecha, des, alm, cen, total))
-
-    conn.commit(); conn.close()
+    _apply_cell(cur, u, fecha, campo, valor)
+    refresh_grid(cur, u['centro_id'], fecha)
+    conn.commit()
+    invalidate_settings()  # grid_version sube si el mes editado estaba cerrado
     return jsonify(ok=True)
 
 
+@app.post('/admin/update/batch')
+def admin_update_batch():
+    """Varias celdas de un centro en una transacción: {"centro": ..., "cells": [{fecha, campo, valor}, ...]}."""
+    if not session.get('email') or session['email'] not in ADMIN_EMAILS:
+        return jsonify(ok=False, error="no_auth"), 403
+    data = request.get_json(force=True, silent=True) or {}
+    centro = str(data.get('centro') or '').strip()
+    cells = data.get('cells')
+    if not centro or not isinstance(cells, list):
+        return jsonify(ok=False, error="payload_invalido"), 400
+    if len(cells) > BULK_MAX_ROWS:
+        return jsonify(ok=False, error="demasiadas_filas", max=BULK_MAX_ROWS), 400
+
+    u = directory().centro_user.get(centro)
+    if not u:
+        return jsonify(ok=False, error="centro_no_configurado"), 400
+    conn = db(); cur = conn.cursor()
+
+    results, meses = [], set()
+    for i, item in enumerate(cells):
+        cell, err = _parse_cell(item) if isinstance(item, dict) else (None, "payload_invalido")
+        if err:
+            results.append({'i': i, 'ok': False, 'error': err}); continue
+        fecha, campo, valor = cell
+        _apply_cell(cur, u, fecha, campo, valor)
+        meses.add(fecha[:7])
+        results.append({'i': i, 'ok': True})
+    for mes in sorted(meses):
+        refresh_grid(cur, u['centro_id'], f"{mes}-01")
+    conn.commit()
+    invalidate_settings()
+    return jsonify(ok=all(r['ok'] for r in results), results=results)
+
+
 # -------------------------------------------------
-# CSV export (modificado sin microsegundos)
+# ADMIN — API bulk (carga masiva en una transacción)
 # -------------------------------------------------
-@app.route('/export.csv')
-def export_csv():
+BULK_FIELDS = ('centro', 'fecha', 'desayunos', 'almuerzos', 'cenas')
+BULK_MAX_ROWS = int(os.environ.get("BULK_MAX_ROWS", "5000"))  # también tope de celdas de /admin/update/batch
+
+
+def _bulk_rows_from_request():
+    """(filas, None) del lote, o (None, código de error).
+
+    JSON ({"rows": [...]} o lista; cada fila dict o lista) o CSV UTF-8 con encabezado (';' o ',').
+    """
+    upload = request.files.get('file')
+    if upload is not None or (request.mimetype or '').startswith('text/'):
+        import io, csv
+        try:
+            text = (upload.read() if upload is not None else request.get_data()).decode('utf-8-sig')
+        except UnicodeDecodeError:
+            return None, 'encoding_invalido'  # p. ej. CSV de Excel en Latin-1: guardarlo como "CSV UTF-8"
+        try:
+            dialect = csv.Sniffer().sniff(text[:2048], delimiters=';,')
+        except csv.Error:
+            dialect = csv.excel
+        return list(csv.DictReader(io.StringIO(text), dialect=dialect)), None
+    data = request.get_json(force=True, silent=True)
+    if isinstance(data, dict):
+        data = data.get('rows')
+    if not isinstance(data, list):
+        return None, 'payload_invalido'
+    return [dict(zip(BULK_FIELDS, r)) if isinstance(r, (list, tuple)) else r for r in data], None
+
+
+@app.post('/admin/bulk')
+def admin_bulk():
     if not session.get('email') or session['email'] not in ADMIN_EMAILS:
-        return redirect(url_for('login'))
-    area = (request.args.get('area') or '').strip()
-    centro = (request.args.get('centro') or '').strip()
-    desde = (request.args.get('desde') or '').strip()
-    hasta = (request.args.get('hasta') or '').strip()
+        return jsonify(ok=False, error="no_auth"), 403
+    rows, err = _bulk_rows_from_request()
+    if err:
+        return jsonify(ok=False, error=err), 400
+    if len(rows) > BULK_MAX_ROWS:
+        return jsonify(ok=False, error="demasiadas_filas", max=BULK_MAX_ROWS), 400
+
+    users = directory().centro_user  # igual que admin_update: el primer user del centro firma los días nuevos
+
+    results, params, touched = [], [], set()
+    for i, r in enumerate(rows):
+        if not isinstance(r, dict):
+            results.append({'row': i, 'ok': False, 'error': 'payload_invalido'}); continue
+        centro = str(r.get('centro') or '').strip()
+        fecha = str(r.get('fecha') or '').strip()
+        try:
+            vals = [int(r.get(k)) for k in ('desayunos', 'almuerzos', 'cenas')]
+            if min(vals) < 0: raise ValueError
+        except Exception:
+            results.append({'row': i, 'ok': False, 'error': 'valor_invalido'}); continue
+        if not centro or not fecha:
+            results.append({'row': i, 'ok': False, 'error': 'payload_invalido'}); continue
+        if not fecha_valida(fecha):
+            results.append({'row': i, 'ok': False, 'error': 'fecha_invalida'}); continue
+        u = users.get(centro)
+        if not u:
+            results.append({'row': i, 'ok': False, 'error': 'centro_no_configurado'}); continue
+        des, alm, cen = vals
+        params.append((u['id'], u['email'], u['centro_id'], fecha, des, alm, cen, des + alm + cen))
+        touched.add((u['centro_id'], fecha[:7]))
+        results.append({'row': i, 'ok': True, 'centro': centro, 'fecha': fecha})
 
-    conn = db(); cur = conn.cursor()
-    params = []
-    where = []
-    if area:
-        where.append('area = ?'); params.append(area)
-    if centro:
-        where.append('centro = ?'); params.append(centro)
+    if params:
+        conn = db(); cur = conn.cursor()
+        cur.executemany(q("""
+            INSERT INTO reports(user_id, email, centro_id, fecha, desayunos, almuerzos, cenas, total)
+            VALUES (?,?,?,?,?,?,?,?)
+            ON CONFLICT (centro_id, fecha) DO UPDATE
+            SET desayunos=excluded.desayunos, almuerzos=excluded.almuerzos, cenas=excluded.cenas,
+                total=excluded.total, updated_at=CURRENT_TIMESTAMP
+        """), params)
+        for centro_id, mes in sorted(touched):
+            refresh_grid(cur, centro_id, f"{mes}-01")
+        conn.commit()
+        invalidate_settings()
+
+    applied = len(params)
+    return jsonify(ok=applied == len(rows), applied=applied, rejected=len(rows) - applied, results=results)
+
+
+# -------------------------------------------------
+# CSV export (modificado sin microsegundos; en streaming por lotes)
+# -------------------------------------------------
+EXPORT_BATCH = int(os.environ.get("EXPORT_BATCH", "1000"))
+
+
+EXPORT_HEADER = ["id","usuario_carga","area","centro","fecha","nro_desayuno","nro_almuerzo","nro_cena","total","modificado"]
+
+
+def _fmt_ts(v):
+    try:
+        if hasattr(v, "strftime"):
+            return v.strftime("%Y-%m-%d %H:%M:%S")
+        v2 = str(v).replace("Z", "")
+        return datetime.fromisoformat(v2).strftime("%Y-%m-%d %H:%M:%S")
+    except Exception:
+        return str(v)
+
+
+def export_row(r):
+    return [
+        r["id"], r["email"], r["area"], r["centro"], r["fecha"],
+        r["desayunos"], r["almuerzos"], r["cenas"], r["total"],
+        _fmt_ts(r["updated_at"])
+    ]
+
+
+def export_query(args):
+    """(where, params, sql, nombre de archivo, filtros) del export según los parámetros del query string."""
+    area = (args.get('area') or '').strip()
+    centro = (args.get('centro') or '').strip()
+    desde = (args.get('desde') or '').strip()
+    hasta = (args.get('hasta') or '').strip()
+
+    where, params = centro_filters(area, centro)
     if desde:
         where.append('fecha >= ?'); params.append(desde)
     if hasta:
         where.append('fecha <= ?'); params.append(hasta)
 
-    sql = 'SELECT id, email, area, centro, fecha, desayunos, almuerzos, cenas, total, updated_at FROM reports'
+    sql = ('SELECT r.id, r.email, c.area, c.nombre AS centro, r.fecha, r.desayunos, r.almuerzos, r.cenas, r.total, r.updated_at '
+           'FROM reports r JOIN centros c ON c.id = r.centro_id')
     if where: sql += ' WHERE ' + ' AND '.join(where)
-    sql += ' ORDER BY fecha DESC, centro'
-    cur.execute(q(sql), params)
-    rows = cur.fetchall(); conn.close()
+    sql += ' ORDER BY r.fecha DESC, c.nombre'
+    name = f"dotacion_{(desde or 'ini')}_{(hasta or 'fin')}.csv"
+    return where, params, q(sql), name, (area, centro, desde, hasta)
+
+
+@app.route('/export.csv')
+def export_csv():
+    if not session.get('email') or session['email'] not in ADMIN_EMAILS:
+        return redirect(url_for('login'))
+    where, params, sql, name, filtros = export_query(request.args)
+
+    # la versión del directorio cubre renombres de centros/áreas (el CSV trae los nombres)
+    etag, last_mod = reports_validators(db().cursor(), where, params, get_setting('lock_until'), directory().version, *filtros)
+    cached = not_modified(etag, last_mod)
+    if cached:
+        return cached
 
     import io, csv
-    from datetime import datetime
 
-    def _fmt_ts(v):
+    def generate():
+        # Postgres: cursor con nombre (server-side); SQLite ya entrega filas de a poco con fetchmany
+        conn = db()
+        cur = conn.cursor(name='export_csv') if USE_PG else conn.cursor()
+        cur.execute(sql, params)
+        buf = io.StringIO()
+        w = csv.writer(buf, delimiter=';')
+        w.writerow(EXPORT_HEADER)
+        yield buf.getvalue().encode('utf-8-sig')
         try:
-            if hasattr(v, "strftime"):
-                return v.strftime("%Y-%m-%d %H:%M:%S")
-            v2 = str(v).replace("Z", "")
-            return datetime.fromisoformat(v2).strftime("%Y-%m-%d %H:%M:%S")
-        except Exception:
-            return str(v)
+            while True:
+                rows = cur.fetchmany(EXPORT_BATCH)
+                if not rows:
+                    break
+                buf.seek(0); buf.truncate()
+                for r in rows:
+                    w.writerow(export_row(r))
+                yield buf.getvalue().encode('utf-8')
+        finally:
+            cur.close()
+
+    resp = Response(stream_with_context(generate()), mimetype='text/csv')
+    resp.headers.set('Content-Disposition', 'attachment', filename=name)
+    return with_validators(resp, etag, last_mod)
+
+
+# -------------------------------------------------
+# Estadísticas agregadas (/api/stats): todo se calcula en la BD
+# -------------------------------------------------
+STATS_MAX_DAYS = int(os.environ.get("STATS_MAX_DAYS", "366"))
+
+# número de día para las ventanas RANGE (ordenar por entero, igual en ambos motores)
+DAYNUM_SQL = "(CAST(fecha AS DATE) - DATE '2000-01-01')" if USE_PG else "CAST(julianday(fecha) AS INTEGER)"
+
+# Una sola consulta: filas 'centro', 'area' y 'dia' unidas con UNION ALL.
+# Los días sin reporte de un centro son sus 'SI' (faltantes). prom_diario y las
+# medias de 7 días (última semana del rango y la anterior) promedian el total de
+# los días con reporte; en un área son la suma de las de sus centros y en el
+# diario, medias móviles (ventana RANGE) del total del día. Los SUM del área
+# llevan CAST a BIGINT: en Postgres SUM(bigint) es numeric y llegaría como Decimal.
+STATS_SQL = """
+    WITH c AS ({centros}),
+    r AS (
+        SELECT r.centro_id, r.fecha, {daynum} AS n, r.desayunos, r.almuerzos, r.cenas, r.total
+        FROM reports r JOIN c ON c.id = r.centro_id
+        WHERE r.fecha BETWEEN ? AND ?
+    ),
+    pc AS (
+        SELECT c.centro, c.area,
+               COALESCE(SUM(r.desayunos), 0) AS desayunos, COALESCE(SUM(r.almuerzos), 0) AS almuerzos,
+               COALESCE(SUM(r.cenas), 0) AS cenas, COALESCE(SUM(r.total), 0) AS total,
+               COUNT(DISTINCT r.fecha) AS dias,
+               CAST(AVG(r.total) AS DOUBLE PRECISION) AS prom_diario,
+               CAST(AVG(CASE WHEN r.fecha > ? THEN r.total END) AS DOUBLE PRECISION) AS media_7d,
+               CAST(AVG(CASE WHEN r.fecha > ? AND r.fecha <= ? THEN r.total END) AS DOUBLE PRECISION) AS media_7d_ant
+        FROM c LEFT JOIN r ON r.centro_id = c.id
+        GROUP BY c.centro, c.area
+    ),
+    dia AS (
+        SELECT fecha, n, SUM(desayunos) AS desayunos, SUM(almuerzos) AS almuerzos, SUM(cenas) AS cenas,
+               SUM(total) AS total, COUNT(DISTINCT centro_id) AS centros
+        FROM r GROUP BY fecha, n
+    )
+    SELECT 'centro' AS tipo, centro AS clave, area, 1 AS centros, desayunos, almuerzos, cenas, total, dias,
+           ? - dias AS faltantes, prom_diario, media_7d, media_7d_ant
+    FROM pc
+    UNION ALL
+    SELECT 'area', area, area, COUNT(*), CAST(SUM(desayunos) AS BIGINT), CAST(SUM(almuerzos) AS BIGINT),
+           CAST(SUM(cenas) AS BIGINT), CAST(SUM(total) AS BIGINT), CAST(SUM(dias) AS BIGINT),
+           CAST(SUM(? - dias) AS BIGINT), SUM(prom_diario), SUM(media_7d), SUM(media_7d_ant)
+    FROM pc GROUP BY area
+    UNION ALL
+    SELECT 'dia', fecha, NULL, centros, desayunos, almuerzos, cenas, total, centros,
+           (SELECT COUNT(*) FROM c) - centros, NULL,
+           CAST(AVG(total) OVER (ORDER BY n RANGE BETWEEN 6 PRECEDING AND CURRENT ROW) AS DOUBLE PRECISION),
+           CAST(AVG(total) OVER (ORDER BY n RANGE BETWEEN 13 PRECEDING AND 7 PRECEDING) AS DOUBLE PRECISION)
+    FROM dia
+    ORDER BY tipo, clave
+"""
+
+# tipo de fila -> (lista del JSON, nombre de la clave, campos); en 'dia', centros = los que reportaron
+STATS_OUT = {
+    'centro': ('centros', 'centro', ('area', 'desayunos', 'almuerzos', 'cenas', 'total', 'dias', 'faltantes',
+                                     'prom_diario', 'media_7d', 'media_7d_ant')),
+    'area': ('areas', 'area', ('centros', 'desayunos', 'almuerzos', 'cenas', 'total', 'dias', 'faltantes',
+                               'prom_diario', 'media_7d', 'media_7d_ant')),
+    'dia': ('diario', 'fecha', ('centros', 'desayunos', 'almuerzos', 'cenas', 'total', 'faltantes',
+                                'media_7d', 'media_7d_ant')),
+}
+
+
+def stats_query(args):
+    """(sql, params, rango) de /api/stats según el query string, o (None, None, error).
+
+    Por defecto el mes en curso hasta hoy; `hasta` no pasa de hoy (los días
+    futuros no son faltantes).
+    """
+    area = (args.get('area') or '').strip()
+    centro = (args.get('centro') or '').strip()
+    today = date.today()
+    try:
+        desde = date.fromisoformat(args.get('desde') or today.replace(day=1).isoformat())
+        hasta = min(date.fromisoformat(args.get('hasta') or today.isoformat()), today)
+    except ValueError:
+        return None, None, "fecha_invalida"
+    dias = (hasta - desde).days + 1
+    if dias < 1:
+        return None, None, "rango_vacio"
+    if dias > STATS_MAX_DAYS:
+        return None, None, "rango_muy_largo"
+
+    centros_sql, params = admin_centros_sql(area)
+    if centro:
+        centros_sql = f"SELECT * FROM ({centros_sql}) c0 WHERE centro = ?"
+        params = params + [centro]
+    semana = (hasta - timedelta(days=7)).isoformat()
+    params += [desde.isoformat(), hasta.isoformat(), semana, (hasta - timedelta(days=14)).isoformat(), semana, dias, dias]
+    rango = {'desde': desde.isoformat(), 'hasta': hasta.isoformat(), 'dias': dias, 'area': area, 'centro': centro}
+    return q(STATS_SQL.format(centros=centros_sql, daynum=DAYNUM_SQL)), params, rango
+
 
-    buf = io.StringIO()
-    w = csv.writer(buf, delimiter=';')
-    w.writerow(["id","usuario_carga","area","centro","fecha","nro_desayuno","nro_almuerzo","nro_cena","total","modificado"])
+def stats_payload(rows, rango):
+    out = dict(rango, centros=[], areas=[], diario=[])
     for r in rows:
-        w.writerow([
-            r["id"], r["email"], r["area"], r["centro"], r["fecha"],
-            r["desayunos"], r["almuerzos"], r["cenas"], r["total"],
-            _fmt_ts(r["updated_at"])
-        ])
-
-    import io as iob
-    mem = iob.BytesIO(buf.getvalue().encode('utf-8-sig')); mem.seek(0)
-    name = f"dotacion_{(desde or 'ini')}_{(hasta or 'fin')}.csv"
-    return send_file(mem, mimetype='text/csv', as_attachment=True, download_name=name)
+        lista, clave, campos = STATS_OUT[r['tipo']]
+        item = {clave: r['clave']}
+        for k in campos:
+            item[k] = round(r[k], 2) if isinstance(r[k], float) else r[k]
+        out[lista].append(item)
+    return out
+
+
+@app.get('/api/stats')
+def api_stats():
+    """Totales, promedios diarios, medias móviles de 7 días y faltantes ('SI') por área, centro y día."""
+    if not session.get('email') or session['email'] not in ADMIN_EMAILS:
+        return jsonify(ok=False, error="no_auth"), 403
+    sql, params, rango = stats_query(request.args)
+    if sql is None:
+        return jsonify(ok=False, error=rango), 400
+
+    cur = db().cursor()
+    where, wparams = ['fecha BETWEEN ? AND ?'], [rango['desde'], rango['hasta']]
+    # la versión del directorio cubre renombres de centros/áreas (el JSON trae los nombres)
+    etag, last_mod = reports_validators(cur, where, wparams, directory().version, *rango.values())
+    cached = not_modified(etag, last_mod)
+    if cached:
+        return cached
+    cur.execute(sql, params)
+    return with_validators(jsonify(stats_payload(cur.fetchall(), rango)), etag, last_mod)
 
 
 # -------------------------------------------------
@@ -884,9 +2566,9 @@ def run_self_tests():
 def run_server():
     host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', '5000'))
-    app.run(host=host, port=port, debug=False, use_reloader=False, threaded=False)
+    # solo desarrollo; en producción: gunicorn -c gunicorn.conf.py app:app
+    app.run(host=host, port=port, debug=False, use_reloader=False, threaded=True)
 
 if __name__ == '__main__':
-    app.jinja_env.globals['BASE'] = BASE
     run_server()
 
@@ -0,0 +1,424 @@
+"""Modo async (ASGI) sobre Postgres: uvicorn asgi:app --workers 2
+
+formulario, admin, admin_centro, admin_update y export_csv corren como vistas
+async (Quart) sobre un AsyncConnectionPool de psycopg: mientras una consulta
+espera, el mismo proceso atiende otros centros, sin un hilo por request. Usan
+las mismas URLs, plantillas, SQL y sesión (cookie firmada con APP_SECRET) que
+app.py. El resto de las rutas (login, historial, bloqueo, bulk, /metrics...) se
+delega a la app Flask a través de asgiref (WSGI en un hilo).
+
+Requiere DATABASE_URL y requirements-async.txt.
+"""
+import csv
+import io
+import json
+import os
+import time
+from datetime import date
+
+from asgiref.wsgi import WsgiToAsgi
+from jinja2 import DictLoader
+from markupsafe import Markup
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from quart import Quart, Response, jsonify, redirect, render_template, request, session, url_for
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header
+
+import app as sync
+
+if not sync.USE_PG:
+    raise RuntimeError("asgi.py requiere Postgres: define DATABASE_URL")
+
+ASYNC_POOL_MIN = int(os.environ.get("ASYNC_POOL_MIN", "1"))
+ASYNC_POOL_MAX = int(os.environ.get("ASYNC_POOL_MAX", "10"))
+ASYNC_RESPONSE_TIMEOUT = float(os.environ.get("ASYNC_RESPONSE_TIMEOUT", "300"))  # export_csv largo
+
+ASYNC_ENDPOINTS = {'formulario', 'admin', 'admin_centro', 'admin_update', 'export_csv'}
+
+qapp = Quart(__name__)
+qapp.secret_key = sync.APP_SECRET
+qapp.config['RESPONSE_TIMEOUT'] = ASYNC_RESPONSE_TIMEOUT
+qapp.jinja_loader = DictLoader(sync.TEMPLATES)
+qapp.jinja_env.globals['APP_CSS_HASH'] = sync.APP_CSS_HASH
+
+# url_for en las plantillas: las rutas que atiende Flask se registran sin vista
+for _rule in sync.app.url_map.iter_rules():
+    if _rule.endpoint not in ASYNC_ENDPOINTS and _rule.endpoint != 'static':
+        qapp.add_url_rule(_rule.rule, _rule.endpoint, methods=_rule.methods - {'HEAD', 'OPTIONS'})
+
+pool = AsyncConnectionPool(sync.PG_DSN, min_size=ASYNC_POOL_MIN, max_size=ASYNC_POOL_MAX,
+                           timeout=sync.DB_POOL_TIMEOUT, kwargs={"row_factory": dict_row}, open=False)
+
+
+@qapp.before_serving
+async def _open_pool():
+    await pool.open()
+
+
+@qapp.after_serving
+async def _close_pool():
+    await pool.close()
+
+
+# -------------------------------------------------
+# Versiones async de los helpers con BD (comparten cachés y SQL con app.py)
+# -------------------------------------------------
+async def get_setting(conn, key: str, default: str = '') -> str:
+    """Como app.get_setting: caché del proceso revalidada con settings_version cada SETTINGS_TTL."""
+    cache = sync._settings_cache
+    if cache["values"] is None or time.monotonic() - cache["checked_at"] >= sync.SETTINGS_TTL:
+        cur = conn.cursor()
+        stale = True
+        if cache["values"] is not None:
+            await cur.execute("SELECT value FROM settings WHERE key='settings_version'")
+            row = await cur.fetchone()
+            stale = (row['value'] if row else None) != cache["version"]
+        if stale:
+            await cur.execute("SELECT key, value FROM settings")
+            rows = await cur.fetchall()
+            with sync._settings_lock:
+                sync._store_settings(rows)
+        else:
+            cache["checked_at"] = time.monotonic()
+    return (cache["values"] or {}).get(key, default)
+
+
+async def directory(conn) -> sync.Directory:
+    """Como app.directory: el mismo objeto del proceso, releído al cambiar directory_version."""
+    version = await get_setting(conn, 'directory_version')
+    d = sync._directory["dir"]
+    if d is None or d.version != version:
+        cur = conn.cursor()
+        await cur.execute(sync.DIRECTORY_CENTROS_SQL)
+        centros = await cur.fetchall()
+        await cur.execute(sync.DIRECTORY_USERS_SQL)
+        d = sync._directory["dir"] = sync.Directory(version, centros, await cur.fetchall())
+    return d
+
+
+async def month_grid(conn, mes: str, lock_until: str, versions: dict, centro_id: int = None):
+    """Como app.month_grid: meses abiertos en vivo, cerrados desde la caché compartida."""
+    cur = conn.cursor()
+    if not sync.month_closed(mes, lock_until):
+        await cur.execute(*sync.month_grid_query(mes, centro_id))
+        return sync.grid_map(await cur.fetchall())
+    key = (mes, lock_until, await get_setting(conn, 'grid_version'))
+    rows = sync.closed_cache_get(key, versions, [centro_id] if centro_id is not None else list(versions))
+    if rows is None:
+        await cur.execute(*sync.data_versions_query())
+        snap = sync.version_map(await cur.fetchall())
+        await cur.execute(*sync.month_grid_query(mes))
+        rows = sync.grid_map(await cur.fetchall())
+        sync.closed_cache_put(key, snap, rows)
+    if centro_id is not None:
+        return {centro_id: rows[centro_id]} if centro_id in rows else {}
+    return rows
+
+
+async def refresh_grid(conn, centro_id: int, fecha: str, lock_until: str):
+    """Como app.refresh_grid, en la transacción de la escritura."""
+    mes = fecha[:7]
+    cur = conn.cursor()
+    await cur.execute(sync.q(sync.GRID_MONTH_REPORTS_SQL), (centro_id, f"{mes}-01", f"{mes}-31"))
+    rows = await cur.fetchall()
+    if rows:
+        await cur.execute(sync.q(sync.GRID_UPSERT_SQL), (centro_id, mes, json.dumps(sync._grid_dias(rows))))
+    else:
+        await cur.execute(sync.q(sync.GRID_DELETE_SQL), (centro_id, mes))
+    await cur.execute(sync.q(sync.BUMP_DATA_VERSION_SQL + ' WHERE id=?'), (centro_id,))
+    if sync.month_closed(mes, lock_until):
+        for sql in sync.BUMP_GRID_SQL:
+            await cur.execute(sql)
+
+
+async def grid_fragments(conn, tpl, cal, lock_until, centros):
+    """Como app.grid_fragments: misma caché de fragmentos, render async solo de los que faltan."""
+    if not centros:
+        return []
+    origen = None
+    if sync.month_closed(cal['mes'], lock_until):
+        origen = (lock_until, await get_setting(conn, 'grid_version'))
+    cur = conn.cursor()
+    await cur.execute(*sync.data_versions_query(centros[0]['id'] if len(centros) == 1 else None))
+    versions = sync.version_map(await cur.fetchall())
+    keys = sync.fragment_keys(tpl, cal, centros, versions, origen)
+    out = sync.fragment_cache_get(keys)
+    missing = [i for i, html in enumerate(out) if html is None]
+    if missing:
+        grid = await month_grid(conn, cal['mes'], lock_until, versions, centros[missing[0]]['id'] if len(missing) == 1 else None)
+        t = qapp.jinja_env.get_template(tpl)
+        for i in missing:
+            out[i] = Markup(await t.render_async(sync.fragment_context(centros[i], grid.get(centros[i]['id']), cal)))
+            sync.fragment_cache_put(keys[i], out[i])
+    return out
+
+
+async def reports_validators(conn, where, params, *extra):
+    cur = conn.cursor()
+    await cur.execute(sync.validators_sql(where), params)
+    return sync.validators_from_row(await cur.fetchone(), extra)
+
+
+def with_validators(resp, etag, last_modified):
+    resp.set_etag(etag, weak=True)
+    if last_modified:
+        resp.last_modified = last_modified
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+
+def not_modified(etag, last_modified):
+    if request.if_none_match.contains_weak(etag):
+        return with_validators(Response('', status=304), etag, last_modified)
+    return None
+
+
+def is_admin():
+    return bool(session.get('email')) and session['email'] in sync.ADMIN_EMAILS
+
+
+def calendar_from_request():
+    return sync.month_calendar(request.args.get('year'), request.args.get('month'))
+
+
+# -------------------------------------------------
+# Vistas async (mismo comportamiento que sus pares en app.py)
+# -------------------------------------------------
+@qapp.route('/form', methods=['GET', 'POST'])
+async def formulario():
+    if not session.get('email') or 'centro_id' not in session:
+        return redirect(url_for('login'))
+    cal = calendar_from_request()
+    compact = sync.compact_mode(request.args, request.headers, session)
+
+    msg_ok = msg_err = None
+    datos = {"desayunos":0, "almuerzos":0, "cenas":0, "total":0}
+    selected_fecha = ''
+
+    async with pool.connection() as conn:
+        lock_until = await get_setting(conn, 'lock_until')
+        if request.method == 'POST':
+            fecha, vals, msg_err = sync.parse_report_form(await request.form, lock_until)
+            selected_fecha = fecha
+            if vals:
+                des, alm, cen = vals
+                total = des + alm + cen
+                cur = conn.cursor()
+                await cur.execute(sync.q(sync.REPORT_INSERT_SQL),
+                                  (session['user_id'], session['email'], session['centro_id'], fecha, des, alm, cen, total))
+                if cur.rowcount == 0:
+                    await conn.rollback()
+                    msg_err = 'Ese día ya está cargado. Si necesitas corregirlo, contacta a Servicios.'
+                else:
+                    await refresh_grid(conn, session['centro_id'], fecha, lock_until)
+                    await conn.commit()
+                    msg_ok = 'Registro enviado.'
+                    datos = {"desayunos":des, "almuerzos":alm, "cenas":cen, "total":total}
+                    selected_fecha = ''
+        else:
+            etag, last_mod = await reports_validators(conn, *sync.month_scope(session['centro_id'], cal['mes']),
+                session['email'], lock_until, cal['mes'], date.today().isoformat(), compact, sync.TEMPLATES_HASH)
+            cached = not_modified(etag, last_mod)
+            if cached:
+                return cached
+        blocks = await grid_fragments(conn, 'grid_form_c.html' if compact else 'grid_form.html', cal, lock_until,
+                                      [{'id': session['centro_id'], 'centro': session['centro'], 'area': session['area']}])
+
+    html = await render_template(
+        'form.html', title='Carga diaria', hoy=date.today().isoformat(), datos=datos, ok=msg_ok, error=msg_err,
+        lock_until=lock_until, selected_fecha=selected_fecha, month_days=cal['month_days'], cal=cal,
+        today_day=cal['today_day'], unlock_from=sync.unlock_from(lock_until), blocks=blocks, compact=compact,
+        nav_endpoint='formulario', nav_args={}
+    )
+    if request.method == 'GET':
+        return with_validators(Response(html), etag, last_mod)
+    return html
+
+
+@qapp.route('/admin')
+async def admin():
+    if not is_admin():
+        return redirect(url_for('login'))
+    area = (request.args.get('area') or '').strip()
+    centro = (request.args.get('centro') or '').strip()
+    cal = calendar_from_request()
+    month_days, today_day = cal['month_days'], cal['today_day']
+    compact = sync.compact_mode(request.args, request.headers, session)
+
+    async with pool.connection() as conn:
+        lock_until = await get_setting(conn, 'lock_until')
+        dir_ = await directory(conn)
+        etag, last_mod = await reports_validators(conn, *sync.admin_scope(area, centro, cal['mes']), session['email'],
+            lock_until, area, centro, cal['mes'], date.today().isoformat(), dir_.version, compact, sync.TEMPLATES_HASH)
+        cached = not_modified(etag, last_mod)
+        if cached:
+            return cached
+        CENTROS_OPT, centros = sync.admin_tablero(dir_, area, centro)
+        blocks = await grid_fragments(conn, 'grid_admin_c.html' if compact else 'grid_admin.html', cal, lock_until, centros)
+
+    html = await render_template('admin.html', title='Tablero', AREAS=dir_.areas, area=area, centro=centro,
+        CENTROS_OPT=CENTROS_OPT, lock_until=lock_until, unlock_from=sync.unlock_from(lock_until),
+        month_days=month_days, cal=cal, today_day=today_day, blocks=blocks, compact=compact,
+        nav_endpoint='admin', nav_args={'area': area, 'centro': centro}
+    )
+    return with_validators(Response(html), etag, last_mod)
+
+
+@qapp.route('/admin/centro')
+async def admin_centro():
+    if not is_admin():
+        return redirect(url_for('login'))
+    centro = (request.args.get('c') or '').strip()
+    if not centro:
+        return redirect(url_for('admin'))
+    cal = calendar_from_request()
+    month_days, today_day = cal['month_days'], cal['today_day']
+
+    async with pool.connection() as conn:
+        dir_ = await directory(conn)
+        c = dir_.centros.get(centro)
+        if not c:
+            return redirect(url_for('admin'))
+        lock_until = await get_setting(conn, 'lock_until')
+        etag, last_mod = await reports_validators(conn, *sync.month_scope(c['id'], cal['mes']), session['email'],
+            lock_until, centro, cal['mes'], date.today().isoformat(), dir_.version, sync.TEMPLATES_HASH)
+        cached = not_modified(etag, last_mod)
+        if cached:
+            return cached
+        grid = (await grid_fragments(conn, 'grid_detail.html', cal, lock_until, [c]))[0]
+
+    html = await render_template(
+        'detail.html', title=f'Detalle {centro}', centro=centro,
+        month_days=month_days, today_day=today_day, grid=grid,
+        year=cal['year'], month=cal['month'], cal=cal, nav_endpoint='admin_centro', nav_args={'c': centro}
+    )
+    return with_validators(Response(html), etag, last_mod)
+
+
+@qapp.post('/admin/update')
+async def admin_update():
+    if not is_admin():
+        return jsonify(ok=False, error="no_auth"), 403
+    data = await request.get_json(force=True, silent=True) or {}
+    centro = str(data.get('centro') or '').strip()
+    cell, err = sync._parse_cell(data)
+    if err:
+        return jsonify(ok=False, error=err), 400
+    if not centro:
+        return jsonify(ok=False, error="payload_invalido"), 400
+    fecha, campo, valor = cell
+
+    async with pool.connection() as conn:
+        u = (await directory(conn)).centro_user.get(centro)
+        if not u:
+            return jsonify(ok=False, error="centro_no_configurado"), 400
+        cur = conn.cursor()
+        lock_until = await get_setting(conn, 'lock_until')
+        await cur.execute(*sync._apply_cell_stmt(u, fecha, campo, valor))
+        await refresh_grid(conn, u['centro_id'], fecha, lock_until)
+        await conn.commit()
+    sync.invalidate_settings()  # grid_version sube si el mes editado estaba cerrado
+    return jsonify(ok=True)
+
+
+@qapp.route('/export.csv')
+async def export_csv():
+    if not is_admin():
+        return redirect(url_for('login'))
+    where, params, sql, name, filtros = sync.export_query(request.args)
+
+    async with pool.connection() as conn:
+        etag, last_mod = await reports_validators(conn, where, params, await get_setting(conn, 'lock_until'),
+                                                  (await directory(conn)).version, *filtros)
+    cached = not_modified(etag, last_mod)
+    if cached:
+        return cached
+
+    async def generate():
+        # la conexión se toma al empezar a enviar y se devuelve al terminar (cursor server-side)
+        async with pool.connection() as conn:
+            async with conn.cursor(name='export_csv') as cur:
+                await cur.execute(sql, params)
+                buf = io.StringIO()
+                w = csv.writer(buf, delimiter=';')
+                w.writerow(sync.EXPORT_HEADER)
+                yield buf.getvalue().encode('utf-8-sig')
+                while True:
+                    rows = await cur.fetchmany(sync.EXPORT_BATCH)
+                    if not rows:
+                        break
+                    buf.seek(0); buf.truncate()
+                    for r in rows:
+                        w.writerow(sync.export_row(r))
+                    yield buf.getvalue().encode('utf-8')
+
+    resp = Response(generate(), mimetype='text/csv')
+    resp.headers.set('Content-Disposition', 'attachment', filename=name)
+    return with_validators(resp, etag, last_mod)
+
+
+# -------------------------------------------------
+# Compresión de las vistas async (las de Flask ya salen comprimidas por app._compress)
+# -------------------------------------------------
+def _start_headers(start, drop=(), add=()):
+    headers = [(k, v) for k, v in start['headers'] if k.lower() not in drop]
+    return {**start, 'headers': headers + list(add)}
+
+
+async def compressed(inner, scope, receive, send):
+    """Como app._compress, sobre los mensajes ASGI: el inicio se retiene hasta el primer trozo del
+    cuerpo (para no comprimir respuestas chicas) y cada trozo sale comprimido con flush."""
+    headers = dict(scope['headers'])
+    encoding = sync.pick_encoding(parse_accept_header(headers.get(b'accept-encoding', b'').decode('latin-1')))
+    if encoding is None or scope['method'] == 'HEAD':
+        return await inner(scope, receive, send)
+    state = {'start': None, 'comp': None}
+    vary = (b'vary', b'Accept-Encoding')
+
+    async def send_compressed(message):
+        if message['type'] == 'http.response.start':
+            h = {k.lower(): v for k, v in message['headers']}
+            mimetype = h.get(b'content-type', b'').decode('latin-1').split(';')[0].strip()
+            if sync.compressible(message['status'], mimetype, h.get(b'content-encoding')):
+                state['start'] = message
+                return
+        elif message['type'] == 'http.response.body' and state['start'] is not None:
+            body, more = message.get('body', b''), message.get('more_body', False)
+            if state['comp'] is None:
+                if not more and len(body) < sync.COMPRESS_MIN_BYTES:
+                    await send(_start_headers(state['start'], add=[vary]))
+                    state['start'] = None
+                    return await send(message)
+                state['comp'] = sync.Compressor(encoding)
+                await send(_start_headers(state['start'], drop=(b'content-length',),
+                                          add=[vary, (b'content-encoding', encoding.encode())]))
+            body = state['comp'].chunk(body) + (b'' if more else state['comp'].finish())
+            return await send({'type': 'http.response.body', 'body': body, 'more_body': more})
+        await send(message)
+
+    await inner(scope, receive, send_compressed)
+
+
+# -------------------------------------------------
+# Despacho ASGI: rutas async a Quart, el resto a Flask
+# -------------------------------------------------
+_flask = WsgiToAsgi(sync.app)
+_urls = sync.app.url_map.bind('')
+
+
+def _endpoint(scope):
+    try:
+        endpoint, _ = _urls.match(scope['path'], method=scope['method'])
+    except HTTPException:
+        return None
+    return endpoint
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await qapp(scope, receive, send)
+    elif scope['type'] == 'http' and _endpoint(scope) in ASYNC_ENDPOINTS:
+        await compressed(qapp, scope, receive, send)
+    else:
+        await _flask(scope, receive, send)
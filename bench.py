@@ -0,0 +1,291 @@
+"""Benchmark / prueba de carga de las rutas principales.
+
+Siembra un dataset sintético (cientos de centros, varios años de reports diarios)
+con el esquema de init_db() y mide /login, /form GET/POST, /admin, /admin/centro,
+/admin/update y /export.csv con el test client de Flask, en serie y con carga
+concurrente. Reporta p50/p95/p99, consultas por request (header Server-Timing) y
+RSS máximo.
+
+    python bench.py                          # SQLite en un archivo temporal
+    BENCH_DATABASE_URL=postgresql://... python bench.py --backend pg
+    python bench.py --backend all --json out.json --baseline prev.json
+
+Nunca usa DATABASE_URL: apunta BENCH_DATABASE_URL a una base desechable, se le
+agregan centros BENCH* y sus reports.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+BENCH_ADMIN = "bench-admin@multix"
+AREAS = ["AYSEN", "LOS LAGOS", "MAGALLANES", "BIOBIO"]
+ROUTES = ["login", "form_get", "form_post", "admin", "admin_centro", "admin_update", "export_csv"]
+
+
+def percentile(values, p):
+    """Percentil por rango más cercano (values ya ordenados)."""
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def peak_rss_mb():
+    # ru_maxrss: KB en Linux, bytes en macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# -------------------------------------------------
+# Dataset sintético
+# -------------------------------------------------
+def seed(A, n_centros, years):
+    """Inserta BENCH0000.. y sus reports diarios de `years` años hasta ayer; devuelve los centros."""
+    centros = [(f"bench{i:04d}@multix", f"BENCH{i:04d}", AREAS[i % len(AREAS)]) for i in range(n_centros)]
+    end = date.today() - timedelta(days=1)
+    start = end - timedelta(days=365 * years)
+    rnd = random.Random(42)
+    with A.app.app_context():
+        conn = A.db(); cur = conn.cursor()
+        cur.executemany(A.q("INSERT INTO centros(nombre, area) VALUES (?,?) ON CONFLICT (nombre) DO NOTHING"),
+                        [(centro, area) for _, centro, area in centros] + [('ADMIN', 'SERVICIOS')])
+        cur.executemany(A.q("INSERT INTO users(email, centro_id) SELECT ?, id FROM centros WHERE nombre=? ON CONFLICT (email) DO NOTHING"),
+                        [(email, centro) for email, centro, _ in centros] + [(BENCH_ADMIN, 'ADMIN')])
+        cur.execute(A.q("SELECT id, email, centro_id FROM users WHERE email LIKE ?"), ("bench%",))
+        ids = {r['email']: (r['id'], r['centro_id']) for r in cur.fetchall()}
+        n = 0
+        for email, centro, area in centros:
+            rows, d = [], start
+            user_id, centro_id = ids[email]
+            while d <= end:
+                des, alm, cen = rnd.randint(0, 40), rnd.randint(10, 80), rnd.randint(5, 60)
+                rows.append((user_id, email, centro_id, d.isoformat(), des, alm, cen, des + alm + cen))
+                d += timedelta(days=1)
+            cur.executemany(A.q("""
+                INSERT INTO reports(user_id, email, centro_id, fecha, desayunos, almuerzos, cenas, total)
+                VALUES (?,?,?,?,?,?,?,?) ON CONFLICT (email, fecha) DO NOTHING
+            """), rows)
+            n += len(rows)
+        A.rebuild_grid(cur)
+        A.bump_data_version(cur)
+        A.bump_directory_version(cur)
+        conn.commit()
+    A.invalidate_settings()
+    return centros, n
+
+
+# -------------------------------------------------
+# Escenarios (cada uno: un request con el test client)
+# -------------------------------------------------
+class Driver:
+    def __init__(self, A, centros, rnd):
+        self.A, self.centros, self.rnd = A, centros, rnd
+        self.user = A.app.test_client()
+        self.admin = A.app.test_client()
+        self.email, self.centro, _ = rnd.choice(centros)
+        self.user.post('/login', data={'email': self.email})
+        self.admin.post('/login', data={'email': BENCH_ADMIN})
+        self.post_day = date.today() + timedelta(days=rnd.randint(1, 3000))
+
+    def run(self, route):
+        rnd, today = self.rnd, date.today()
+        if route == "login":
+            return self.A.app.test_client().post('/login', data={'email': rnd.choice(self.centros)[0]})
+        if route == "form_get":
+            return self.user.get('/form')
+        if route == "form_post":
+            # días futuros distintos por driver: inserta, no choca con lo sembrado
+            self.post_day += timedelta(days=1)
+            return self.user.post('/form', data={'fecha': self.post_day.isoformat(),
+                                                 'desayunos': 1, 'almuerzos': 2, 'cenas': 3})
+        if route == "admin":
+            back = rnd.randint(0, 11)
+            y, m = divmod(today.year * 12 + today.month - 1 - back, 12)
+            return self.admin.get('/admin', query_string={'year': y, 'month': m + 1})
+        if route == "admin_centro":
+            return self.admin.get('/admin/centro', query_string={'c': rnd.choice(self.centros)[1]})
+        if route == "admin_update":
+            return self.admin.post('/admin/update', json={
+                'centro': rnd.choice(self.centros)[1], 'campo': rnd.choice(['desayunos', 'almuerzos', 'cenas']),
+                'fecha': (today - timedelta(days=rnd.randint(1, 60))).isoformat(), 'valor': rnd.randint(0, 90)})
+        if route == "export_csv":
+            return self.admin.get('/export.csv', query_string={
+                'centro': rnd.choice(self.centros)[1], 'desde': (today - timedelta(days=365)).isoformat()})
+        raise ValueError(route)
+
+
+def timed(driver, route):
+    t0 = time.perf_counter()
+    resp = driver.run(route)
+    resp.get_data()  # consume el streaming de export_csv
+    ms = (time.perf_counter() - t0) * 1000
+    m = re.search(r'desc="(\d+) consultas"', resp.headers.get('Server-Timing', ''))
+    return ms, int(m.group(1)) if m else 0, resp.status_code < 500
+
+
+def summarize(samples):
+    """{ruta: {n, errors, p50, p95, p99, queries}} a partir de [(ruta, ms, consultas, ok)]."""
+    out = {}
+    for route in ROUTES:
+        rs = [s for s in samples if s[0] == route]
+        if not rs:
+            continue
+        ms = sorted(s[1] for s in rs)
+        out[route] = {
+            "n": len(rs), "errors": sum(1 for s in rs if not s[3]),
+            "p50": round(percentile(ms, 50), 2), "p95": round(percentile(ms, 95), 2),
+            "p99": round(percentile(ms, 99), 2), "queries": round(sum(s[2] for s in rs) / len(rs), 2),
+        }
+    return out
+
+
+def run_backend(args):
+    """Corre en el proceso actual con el backend ya fijado por las variables de entorno."""
+    import app as A
+    t0 = time.perf_counter()
+    centros, n_reports = seed(A, args.centros, args.years)
+    seed_s = time.perf_counter() - t0
+
+    rnd = random.Random(7)
+    serial = []
+    driver = Driver(A, centros, rnd)
+    for route in ROUTES:
+        for _ in range(args.warmup):
+            driver.run(route).get_data()
+        for _ in range(args.iterations):
+            serial.append((route,) + timed(driver, route))
+
+    # carga concurrente: mezcla ponderada de rutas, un driver (sesiones propias) por hilo
+    weights = {"login": 1, "form_get": 6, "form_post": 3, "admin": 3, "admin_centro": 3, "admin_update": 2, "export_csv": 1}
+    mix = [r for r, w in weights.items() for _ in range(w)]
+    local = threading.local()
+    lock = threading.Lock()
+    seed_n = [0]
+
+    def one(_):
+        d = getattr(local, "driver", None)
+        if d is None:
+            with lock:
+                seed_n[0] += 1
+                r = random.Random(1000 + seed_n[0])
+            d = local.driver = Driver(A, centros, r)
+        route = d.rnd.choice(mix)
+        return (route,) + timed(d, route)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+        concurrent = list(ex.map(one, range(args.requests)))
+    load_s = time.perf_counter() - t0
+
+    return {
+        "backend": "postgres" if A.USE_PG else "sqlite",
+        "centros": args.centros, "reports": n_reports, "seed_s": round(seed_s, 2),
+        "serial": summarize(serial),
+        "concurrent": dict(summarize(concurrent), _total={
+            "requests": len(concurrent), "concurrency": args.concurrency,
+            "rps": round(len(concurrent) / load_s, 1) if load_s else 0.0,
+            "errors": sum(1 for s in concurrent if not s[3]),
+        }),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def print_report(res):
+    print(f"\n== {res['backend']}: {res['centros']} centros, {res['reports']} reports "
+          f"(siembra {res['seed_s']} s), RSS máx {res['peak_rss_mb']} MB")
+    for phase in ("serial", "concurrent"):
+        tot = res[phase].get("_total")
+        print(f"-- {phase}" + (f": {tot['requests']} req, {tot['concurrency']} hilos, {tot['rps']} req/s, "
+                               f"{tot['errors']} errores" if tot else ""))
+        print(f"   {'ruta':<14}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'consultas':>11}{'err':>5}")
+        for route in ROUTES:
+            s = res[phase].get(route)
+            if s:
+                print(f"   {route:<14}{s['n']:>6}{s['p50']:>10}{s['p95']:>10}{s['p99']:>10}{s['queries']:>11}{s['errors']:>5}")
+
+
+def regressions(results, baseline, max_pct):
+    """Rutas cuyo p95 serial o consultas/request empeoraron más de max_pct % respecto del baseline."""
+    base = {r["backend"]: r for r in baseline}
+    out = []
+    for res in results:
+        prev = base.get(res["backend"])
+        if not prev:
+            continue
+        for route, s in res["serial"].items():
+            p = prev["serial"].get(route)
+            if not p:
+                continue
+            for key in ("p95", "queries"):
+                if p[key] and s[key] > p[key] * (1 + max_pct / 100):
+                    out.append(f"{res['backend']} {route} {key}: {p[key]} -> {s[key]}")
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    ap.add_argument("--backend", choices=["sqlite", "pg", "all"], default="sqlite")
+    ap.add_argument("--centros", type=int, default=200)
+    ap.add_argument("--years", type=int, default=3)
+    ap.add_argument("--iterations", type=int, default=50, help="requests en serie por ruta")
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--requests", type=int, default=1000, help="requests de la fase concurrente")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--json", help="guarda los resultados en este archivo")
+    ap.add_argument("--baseline", help="JSON de una corrida anterior; sale con 1 si hay regresión")
+    ap.add_argument("--max-regression", type=float, default=25.0, help="%% tolerado sobre el baseline")
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        print(json.dumps(run_backend(args)))
+        return 0
+
+    backends = ["sqlite", "pg"] if args.backend == "all" else [args.backend]
+    results = []
+    for backend in backends:
+        # USE_PG se decide al importar app: un proceso por backend
+        env = dict(os.environ, REQUEST_LOG="0", APP_ADMINS=BENCH_ADMIN, SLOW_QUERY_MS="1e9")
+        env.pop("DATABASE_URL", None)
+        tmp = None
+        if backend == "pg":
+            if not os.environ.get("BENCH_DATABASE_URL"):
+                print("pg: define BENCH_DATABASE_URL (base desechable); se omite", file=sys.stderr)
+                continue
+            env["DATABASE_URL"] = os.environ["BENCH_DATABASE_URL"]
+        else:
+            tmp = tempfile.mkdtemp(prefix="bench-")
+            env["APP_DB"] = os.path.join(tmp, "bench.db")
+        cmd = [sys.executable, os.path.abspath(__file__), "--child"]
+        for opt in ("centros", "years", "iterations", "warmup", "requests", "concurrency"):
+            cmd += [f"--{opt}", str(getattr(args, opt))]
+        out = subprocess.run(cmd, env=env, check=True, capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        res = json.loads(out.stdout.strip().splitlines()[-1])
+        print_report(res)
+        results.append(res)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            bad = regressions(results, json.load(f), args.max_regression)
+        for line in bad:
+            print("REGRESIÓN:", line)
+        return 1 if bad else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
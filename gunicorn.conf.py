@@ -0,0 +1,39 @@
+# -------------------------------------------------
+# Gunicorn (producción): gunicorn -c gunicorn.conf.py app:app
+# -------------------------------------------------
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Hilos por worker = conexiones del pool (DB_POOL_MAX): un hilo nunca espera por
+# una conexión. Workers según CPU, acotados para que workers * DB_POOL_MAX no
+# pase de DB_MAX_CONNECTIONS en Postgres.
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "5"))
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", "20"))
+
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", DB_POOL_MAX))
+workers = int(os.environ.get(
+    "WEB_CONCURRENCY",
+    max(1, min(2 * multiprocessing.cpu_count() + 1, DB_MAX_CONNECTIONS // DB_POOL_MAX)),
+))
+
+# init_db() y la compilación de plantillas corren una sola vez en el master
+preload_app = True
+
+# /export.csv puede tardar; al reiniciar se deja terminar lo que está en curso
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+errorlog = "-"
+
+
+def pre_fork(server, worker):
+    # las conexiones abiertas por init_db() en el master no deben compartirse con los workers
+    from app import close_db_connections
+    close_db_connections()